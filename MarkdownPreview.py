@@ -7,15 +7,106 @@ import sys
 import tempfile
 import re
 import json
-import urllib2
+import hashlib
+import base64
+import time
+import threading
+import traceback
+import socket
+import httplib
+import urllib
+import urlparse
+
+try:
+    from PIL import Image
+except ImportError:
+    # no thumbnails then, the images are only loaded lazily
+    Image = None
 
 import desktop
 import markdown2
 
+# (extras, IncrementalMarkdown instance) by view id: kept between conversions
+# so a save only re-renders the blocks that changed.
+incremental_markdowners = {}
+
+# [time of the first, time of the last modification] by view id, for the views
+# with a pending live preview update
+live_preview_updates = {}
+
+# (sha1 of the HTML, stamp of the file) last written by path, so unchanged previews
+# are not written again (which would trigger a LiveReload refresh)
+written_digests = {}
+write_stats = {'written': 0, 'skipped': 0}
+
+# (stamp, contents) of the CSS and script files read by path: see load_cached_utf8
+resource_cache = {}
+
+# (stamps of the files it is made of, html) of the <head> CSS and scripts, by the
+# file name and settings they depend on: see MarkdownPreviewJob.get_head
+head_cache = {}
+HEAD_CACHE_SIZE = 32
+
+# (stamp of the image, (thumbnail filename, its width, the image width) or None) by
+# (image filename, thumbnails folder, thumbnail width): see get_thumbnail
+thumbnail_cache = {}
+THUMBNAIL_FORMATS = ['JPEG', 'PNG']
+
+# the settings used by the preview, copied for use off the main thread
+SETTINGS_KEYS = [
+    'browser', 'parser', 'enable_mathjax', 'enable_highlight', 'enabled_extensions',
+    'incremental_conversion', 'render_cache_size', 'render_cache_path', 'github_mode',
+    'github_oauth_token', 'css', 'allow_css_overrides', 'markdown_filetypes',
+    'path_tempfile', 'strip_yaml_front_matter', 'external_assets', 'fsync_preview_files',
+    'persistent_opener', 'github_api_url', 'github_api_timeout', 'github_chunked',
+    'image_thumbnails', 'image_thumbnail_width'
+]
+
+# the sublime API can only be used from the main thread
+ST_VERSION = sublime.version()
+PACKAGES_PATH = sublime.packages_path()
+
+def main_thread(callback, *args):
+    ''' call callback(*args) on the main thread '''
+    sublime.set_timeout(lambda: callback(*args), 0)
+
+preview_settings = None
+
+def get_settings():
+    ''' return the MarkdownPreview settings, loaded once: the object follows later changes '''
+    global preview_settings
+    if preview_settings is None:
+        preview_settings = sublime.load_settings('MarkdownPreview.sublime-settings')
+    return preview_settings
+
+# (stamp of the Packages folder, whether LiveReload is in it)
+livereload_detection = None
+# the desktop environment is detected once, again when the plugin is reloaded
+desktop.forget_desktop()
+
+def is_livereload_installed():
+    ''' check if LiveReload ST2 extension installed, again only when the Packages folder
+        changes (a package was added or removed)
+    '''
+    global livereload_detection
+    stamp = file_stamp(PACKAGES_PATH)
+    if livereload_detection is None or livereload_detection[0] != stamp:
+        livereload_detection = (stamp, os.path.isdir(os.path.join(PACKAGES_PATH, 'LiveReload')))
+    return livereload_detection[1]
+
+def get_settings_snapshot(settings):
+    ''' return a dict of the preview settings, safe to use from any thread '''
+    snapshot = {}
+    for key in SETTINGS_KEYS:
+        value = settings.get(key)
+        if value is not None:
+            snapshot[key] = value
+    return snapshot
+
 def getTempMarkdownPreviewPath(view):
     ''' return a permanent full path of the temp markdown preview file '''
 
-    settings = sublime.load_settings('MarkdownPreview.sublime-settings')
+    settings = get_settings()
 
     tmp_filename = '%s.html' % view.id()
     if settings.get('path_tempfile'):
@@ -24,28 +115,108 @@ def getTempMarkdownPreviewPath(view):
         tmp_fullpath = os.path.join(tempfile.gettempdir(), tmp_filename)
     return tmp_fullpath
 
-def save_utf8(filename, text):
-    v = sublime.version()
-    if v >= '3000':
-        f = open(filename, 'w', encoding='utf-8')
-        f.write(text)
-        f.close()
-    else: # 2.x
-        f = open(filename, 'w')
-        f.write(text.encode('utf-8'))
-        f.close()
+def utf8_chunks(parts, size=65536):
+    ''' generate the UTF-8 encoding of a list of text parts, at most size characters at a time '''
+    for part in parts:
+        start = 0
+        while start < len(part):
+            end = start + size
+            # don't split a surrogate pair (narrow unicode builds)
+            if end < len(part) and u'\ud800' <= part[end - 1] <= u'\udbff':
+                end += 1
+            yield part[start:end].encode('utf-8')
+            start = end
+
+def utf8_digest(parts):
+    ''' return the sha1 of the UTF-8 encoding of a list of text parts '''
+    sha1 = hashlib.sha1()
+    for chunk in utf8_chunks(parts):
+        sha1.update(chunk)
+    return sha1.hexdigest()
+
+def get_tmp_filename(filename):
+    ''' return a temporary file name next to filename, for this process and thread
+
+        preview_worker and github_worker may write the same file at the same time.
+    '''
+    return '%s.%s.%s.tmp' % (filename, os.getpid(), threading.current_thread().ident)
+
+def save_utf8(filename, text, fsync=False):
+    ''' write text, or a list of text parts, to filename in UTF-8
+
+        the parts are encoded and written a chunk at a time, never joined in memory,
+        to a temporary file renamed over filename once complete: a browser reloading
+        it meanwhile sees the previous version, never a truncated one. with fsync,
+        the data is also flushed to the disk before the rename.
+    '''
+    parts = text
+    if not isinstance(parts, list):
+        parts = [text]
+    tmp_filename = get_tmp_filename(filename)
+    try:
+        f = open(tmp_filename, 'wb', 256 * 1024)
+        try:
+            for chunk in utf8_chunks(parts):
+                f.write(chunk)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            f.close()
+        try:
+            os.rename(tmp_filename, filename)
+        except OSError:
+            # windows doesn't rename over an existing file
+            if os.name != 'nt' or not os.path.exists(filename):
+                raise
+            os.remove(filename)
+            os.rename(tmp_filename, filename)
+    except:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
 
 def load_utf8(filename):
-    v = sublime.version()
+    v = ST_VERSION
     if v >= '3000':
         return open(filename, 'r', encoding='utf-8').read()
     else: # 2.x
         return open(filename, 'r').read().decode('utf-8')
 
 
-def load_resource(name):
-    ''' return file contents for files within the package root folder '''
-    v = sublime.version()
+def file_stamp(filename):
+    ''' return what tells whether filename changed: (mtime, size), None if it doesn't exist '''
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+def load_cached_utf8(filename):
+    ''' return (stamp, contents) of filename, None contents if it doesn't exist
+
+        the contents are kept in resource_cache and only read again once the file changed.
+    '''
+    stamp = file_stamp(filename)
+    if stamp is None:
+        resource_cache.pop(filename, None)
+        return None, None
+    cached = resource_cache.get(filename)
+    if cached and cached[0] == stamp:
+        return cached
+    try:
+        contents = load_utf8(filename)
+    except (IOError, OSError):
+        return None, None
+    resource_cache[filename] = (stamp, contents)
+    return stamp, contents
+
+def load_resource(name, stamps=None):
+    ''' return file contents for files within the package root folder
+
+        the (filename, stamp) of the files looked at are appended to stamps if given.
+    '''
+    v = ST_VERSION
     if v >= '3000':
         try:
             filename = 'Packages/Markdown Preview/'+name
@@ -53,15 +224,63 @@ def load_resource(name):
         except:
             return ''
     else: # 2.x
-        filename = os.path.join(sublime.packages_path(), 'Markdown Preview', name)
+        filenames = [
+            os.path.join(PACKAGES_PATH, 'Markdown Preview', name),
+            os.path.join(PACKAGES_PATH, 'sublimetext-markdown-preview', name) ## why is this ?
+        ]
+        for filename in filenames:
+            stamp, contents = load_cached_utf8(filename)
+            if stamps is not None:
+                stamps.append((filename, stamp))
+            if contents is not None:
+                return contents
+        return ''
 
-        if os.path.isfile(filename):
-            return open(filename, 'r').read().decode('utf-8')
-        else:
-            filename = os.path.join(sublime.packages_path(), 'sublimetext-markdown-preview', name) ## why is this ?
-            if os.path.isfile(filename):
-                return open(filename, 'r').read().decode('utf-8')
-            return ''
+def make_thumbnail(filename, path, max_width):
+    ''' write a max_width wide copy of the image filename in the folder path, named after
+        a hash of the image, return (thumbnail filename, max_width, the image width)
+
+        return None if the image is not wider than max_width or can't be read.
+    '''
+    if Image is None:
+        return None
+    try:
+        image = Image.open(filename)
+        width, height = image.size
+        format = image.format
+        if width <= max_width or format not in THUMBNAIL_FORMATS:
+            return None
+        f = open(filename, 'rb')
+        try:
+            digest = hashlib.sha1(f.read()).hexdigest()[:16]
+        finally:
+            f.close()
+        thumbnail = os.path.join(path, '%s-%d%s' % (digest, max_width, os.path.splitext(filename)[1]))
+        if not os.path.exists(thumbnail):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            image = image.resize((max_width, max(1, height * max_width / width)),
+                                 getattr(Image, 'LANCZOS', getattr(Image, 'ANTIALIAS', None)))
+            tmp_filename = get_tmp_filename(thumbnail)
+            image.save(tmp_filename, format)
+            os.rename(tmp_filename, thumbnail)
+    except (IOError, OSError, ValueError):
+        return None
+    return thumbnail, max_width, width
+
+def get_thumbnail(filename, path, max_width):
+    ''' return make_thumbnail(filename, path, max_width), only made again once the image changed '''
+    stamp = file_stamp(filename)
+    key = (filename, path, max_width)
+    if stamp is None:
+        thumbnail_cache.pop(key, None)
+        return None
+    cached = thumbnail_cache.get(key)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    thumbnail = make_thumbnail(filename, path, max_width)
+    thumbnail_cache[key] = (stamp, thumbnail)
+    return thumbnail
 
 def new_scratch_view(window, text):
     ''' create a new scratch view and paste text content
@@ -80,18 +299,494 @@ def new_scratch_view(window, text):
         new_view.end_edit(new_edit)
     return new_view
 
+# the tags whose relative src or href are made absolute by the postprocessor, and
+# how they start: a document without any doesn't need the postprocessor
+RE_SOURCES = re.compile("""(?P<tag><(?:img|script|a)[^>]+(?:src|href)=["'](?P<src>[^"']+)[^>]*>)""")
+RE_SOURCES_TAG = re.compile('<(?:img|script|a)')
+# the img tags of local images, $2 = their path
+RE_LOCAL_IMG = re.compile(r"""<img\s[^>]*?src=(["'])file://([^"']+)\1[^>]*>""")
+# the urls left alone: with a scheme, absolute paths and anchors
+RE_ABSOLUTE_URL = re.compile(r'[a-zA-Z][\w+.-]*:|/|#')
+RE_CHAR_REF = re.compile(r'&#([xX]?)([0-9a-fA-F]+);')
+
+def resolve_url(base, url):
+    ''' return url made absolute with base, the file:// url of its folder '''
+    scheme = url
+    if '&#' in url:
+        # markdown2 writes the characters of mailto: links as character references
+        scheme = RE_CHAR_REF.sub(lambda match: unichr(int(match.group(2), match.group(1) and 16 or 10)), url)
+    if RE_ABSOLUTE_URL.match(scheme):
+        return url
+    return base + url
+
+# reference link and footnote definitions, which apply to the whole document
+LINK_DEFINITION_RE = re.compile(r'^[ ]{0,3}\[[^\]\n]+\]:[ \t]*\S.*\n?', re.M)
+
+# an ATX heading line: '#foo' and '#hashtag' are not headings
+ATX_HEADING_RE = re.compile(r'#{1,6}(\s|$)')
+
+def split_sections(text):
+    ''' split markdown text into its top-level sections, before each ATX heading
+
+        only a heading after a blank line starts a section: not one in a fenced code
+        block, nor a '#' line continuing a paragraph or a list item. the sections
+        joined give back text.
+    '''
+    sections = []
+    lines = []
+    fence = None
+    for line in text.splitlines(True):
+        stripped = line.lstrip()
+        if fence:
+            if stripped.startswith(fence):
+                fence = None
+        elif stripped.startswith('```') or stripped.startswith('~~~'):
+            fence = stripped[:3]
+        elif lines and not lines[-1].strip() and ATX_HEADING_RE.match(line):
+            sections.append(''.join(lines))
+            lines = []
+        lines.append(line)
+    if lines:
+        sections.append(''.join(lines))
+    return sections
+
+class RenderCache(object):
+    ''' size-bounded on-disk LRU cache of converted markdown
+
+        entries are JSON files named after a hash of everything the conversion
+        depends on; their mtime is bumped on every hit and the least recently
+        used ones are removed once the cache grows over max_size bytes.
+    '''
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, *parts):
+        parts = (RENDER_CACHE_FORMAT,) + parts
+        data = json.dumps(parts, ensure_ascii=False).encode('utf-8')
+        return hashlib.sha1(data).hexdigest()
+
+    def get(self, key):
+        filename = os.path.join(self.path, key + '.json')
+        try:
+            f = open(filename, 'rb')
+            try:
+                value = json.loads(f.read().decode('utf-8'))
+            finally:
+                f.close()
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        data = json.dumps(value).encode('utf-8')
+        filename = os.path.join(self.path, key + '.json')
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            if self.size is None:
+                self.size = sum(size for size, mtime, name in self.entries())
+            tmp_filename = get_tmp_filename(filename)
+            f = open(tmp_filename, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            if os.path.exists(filename):
+                os.remove(tmp_filename)
+                return
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError):
+            return
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.evict()
+
+    def entries(self):
+        ''' return (size, mtime, filename) for all cache entries '''
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.json'):
+                st = os.stat(os.path.join(self.path, name))
+                entries.append((st.st_size, st.st_mtime, name))
+        return entries
+
+    def evict(self):
+        ''' remove the least recently used entries until the cache is 3/4 full '''
+        entries = sorted(self.entries(), key=lambda entry: entry[1])
+        self.size = sum(entry[0] for entry in entries)
+        for size, mtime, name in entries:
+            if self.size <= self.max_size * 3 / 4:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                continue
+            self.size -= size
+
+    def stats(self):
+        total = self.hits + self.misses
+        return 'render cache: %d hits, %d misses (%d%% hit rate), %d KB' % (
+            self.hits, self.misses, total and 100 * self.hits / total,
+            (self.size or 0) / 1024)
+
+render_cache = None
+
+# part of every render cache key: bump it when the HTML produced for the same
+# markdown and settings changes, so the entries made before are not used
+RENDER_CACHE_FORMAT = 1
+
+
+class MarkdownerPool(object):
+    ''' idle markdown2.Markdown instances by (extras, tab_width, safe_mode)
+
+        building a Markdown instance prepares its extras and compiles some regexes:
+        conversions borrow a configured instance instead, which convert() resets.
+        it can be shared by threads, an instance being used by one at a time.
+    '''
+
+    def __init__(self, max_idle=4):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.max_idle = max_idle
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, key):
+        self.lock.acquire()
+        try:
+            markdowners = self.idle.get(key)
+            if markdowners:
+                self.reused += 1
+                return markdowners.pop()
+            self.created += 1
+        finally:
+            self.lock.release()
+        extras, tab_width, safe_mode = key
+        return markdown2.Markdown(extras=list(extras), tab_width=tab_width, safe_mode=safe_mode)
+
+    def release(self, key, markdowner):
+        self.lock.acquire()
+        try:
+            markdowners = self.idle.setdefault(key, [])
+            if len(markdowners) < self.max_idle:
+                markdowners.append(markdowner)
+        finally:
+            self.lock.release()
+
+    def convert(self, text, extras, tab_width=markdown2.DEFAULT_TAB_WIDTH, safe_mode=None,
+                url_resolver=None):
+        key = (frozenset(extras), tab_width, safe_mode)
+        markdowner = self.acquire(key)
+        markdowner.url_resolver = url_resolver
+        try:
+            return markdowner.convert(text)
+        finally:
+            markdowner.url_resolver = None
+            self.release(key, markdowner)
+
+    def stats(self):
+        return 'markdown2 instances: %d created, %d reuses' % (self.created, self.reused)
+
+markdowner_pool = MarkdownerPool()
+
+def get_render_cache(settings):
+    ''' return the render cache configured in settings, or None if it is disabled '''
+    global render_cache
+    max_size = settings.get('render_cache_size', 0) * 1024 * 1024
+    if not max_size:
+        return None
+    path = settings.get('render_cache_path') or os.path.join(tempfile.gettempdir(), 'MarkdownPreviewCache')
+    if render_cache is None or render_cache.path != path:
+        render_cache = RenderCache(path, max_size)
+    render_cache.max_size = max_size
+    return render_cache
+
+def import_ssl():
+    ''' return the ssl module, or None if SSL is not available
+
+        the Python embedded in Sublime Text 2 on Linux is built without _ssl: the
+        copy of ssl.py in lib/linux is used then, with the _ssl.so built against the
+        libssl found on the system.
+    '''
+    try:
+        import ssl
+        return ssl
+    except ImportError:
+        if not sys.platform.startswith('linux'):
+            return None
+    lib = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib')
+    arch = os.path.join(lib, sys.maxsize > 2 ** 32 and 'linux-x64' or 'linux-x32')
+    for version in ['libssl-1.0.0', 'libssl-10', 'libssl-0.9.8']:
+        sys.path.insert(0, os.path.join(arch, version))
+        try:
+            import _ssl
+            break
+        except ImportError:
+            del sys.path[0]
+    else:
+        return None
+    sys.path.insert(0, os.path.join(lib, 'linux'))
+    import ssl
+    return ssl
+
+ssl = import_ssl()
+
+
+class HTTPSConnection(httplib.HTTPConnection):
+    ''' httplib.HTTPSConnection only exists if ssl could be imported before httplib '''
+
+    default_port = httplib.HTTPS_PORT
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        host = self.host
+        if getattr(self, '_tunnel_host', None):
+            # connected to a proxy: CONNECT to the server through it first
+            self.sock = sock
+            self._tunnel()
+            host = self._tunnel_host
+        if hasattr(ssl, 'create_default_context'):
+            # verify the certificate and the host name
+            context = ssl.create_default_context()
+            self.sock = context.wrap_socket(sock, server_hostname=host)
+        else:
+            # the ssl.py of lib/linux has no certificates to verify against
+            self.sock = ssl.wrap_socket(sock)
+
+
+class HTTPConnectionPool(object):
+    ''' idle keep-alive connections by (scheme, host, port, proxy)
+
+        a request borrows a connection to the server, so the TCP and TLS handshakes
+        are only made for the first request, or when the server closed the connection.
+        it can be shared by threads, a connection being used by one at a time.
+
+        like urllib2.urlopen, requests go through the proxies of the http_proxy and
+        https_proxy environment variables or of the OS settings, read once.
+    '''
+
+    def __init__(self, max_idle=2):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.max_idle = max_idle
+        self.created = 0
+        self.reused = 0
+        self.proxies = None
+
+    def get_proxy(self, scheme, host):
+        ''' return the (host, port, Proxy-Authorization header) of the proxy to reach
+            host through, or None to connect to it directly
+        '''
+        if self.proxies is None:
+            self.proxies = urllib.getproxies()
+        proxy = self.proxies.get(scheme)
+        if not proxy or urllib.proxy_bypass(host):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        parts = urlparse.urlsplit(proxy)
+        auth = None
+        if parts.username:
+            credentials = '%s:%s' % (urllib.unquote(parts.username), urllib.unquote(parts.password or ''))
+            auth = 'Basic ' + base64.b64encode(credentials)
+        return parts.hostname, parts.port or 80, auth
+
+    def acquire(self, key, timeout):
+        self.lock.acquire()
+        try:
+            connections = self.idle.get(key)
+            if connections:
+                self.reused += 1
+                connection = connections.pop()
+                connection.sock.settimeout(timeout)
+                return connection, True
+            self.created += 1
+        finally:
+            self.lock.release()
+        scheme, host, port, proxy = key
+        if scheme == 'https':
+            if ssl is None:
+                raise httplib.HTTPException('SSL is not included in your Python installation')
+            if not proxy:
+                return HTTPSConnection(host, port, timeout=timeout), False
+            connection = HTTPSConnection(proxy[0], proxy[1], timeout=timeout)
+            tunnel_headers = proxy[2] and {'Proxy-Authorization': proxy[2]} or None
+            if hasattr(connection, 'set_tunnel'):
+                connection.set_tunnel(host, port or httplib.HTTPS_PORT, tunnel_headers)
+            else:  # python 2.6
+                connection._set_tunnel(host, port or httplib.HTTPS_PORT)
+            return connection, False
+        if proxy:
+            return httplib.HTTPConnection(proxy[0], proxy[1], timeout=timeout), False
+        return httplib.HTTPConnection(host, port, timeout=timeout), False
+
+    def release(self, key, connection):
+        self.lock.acquire()
+        try:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        finally:
+            self.lock.release()
+        connection.close()
+
+    def request(self, method, url, body=None, headers={}, timeout=None):
+        ''' make an HTTP request, return the response status and body
+
+            raises socket.error (socket.timeout after timeout seconds) or
+            httplib.HTTPException if no response could be read.
+        '''
+        parts = urlparse.urlsplit(url)
+        proxy = self.get_proxy(parts.scheme, parts.hostname)
+        key = (parts.scheme, parts.hostname, parts.port, proxy)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        if proxy and parts.scheme == 'http':
+            # an HTTP proxy is sent the whole url
+            path = '%s://%s%s' % (parts.scheme, parts.netloc, path)
+            if proxy[2]:
+                headers = dict(headers, **{'Proxy-Authorization': proxy[2]})
+        while True:
+            connection, reused = self.acquire(key, timeout)
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                if reused and not isinstance(sys.exc_info()[1], socket.timeout):
+                    # the server closed the idle connection: try again with a new one
+                    continue
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self.release(key, connection)
+            return response.status, data
+
+    def stats(self):
+        return 'HTTP connections: %d opened, %d reuses' % (self.created, self.reused)
+
+http_pool = HTTPConnectionPool()
+
+
+class PreviewWorker(object):
+    ''' runs preview jobs one at a time on a background thread
+
+        a job submitted for the same view and target as one still waiting replaces it,
+        and a running job is superseded as soon as a newer one is submitted.
+    '''
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.order = []
+        self.latest = {}
+        self.thread = None
+
+    def submit(self, job):
+        self.condition.acquire()
+        try:
+            if job.key not in self.pending:
+                self.order.append(job.key)
+            self.pending[job.key] = job
+            self.latest[job.key] = job
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.loop, name='MarkdownPreview')
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def superseded(self, job):
+        return self.latest.get(job.key) is not job
+
+    def loop(self):
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.order:
+                    self.condition.wait()
+                job = self.pending.pop(self.order.pop(0))
+            finally:
+                self.condition.release()
+            try:
+                job.run()
+            except Exception:
+                traceback.print_exc()
+                main_thread(sublime.status_message, 'Markdown preview failed, see the console for details')
+            self.condition.acquire()
+            try:
+                if self.latest.get(job.key) is job:
+                    del self.latest[job.key]
+            finally:
+                self.condition.release()
+
+preview_worker = PreviewWorker()
+# the github API conversions wait for the network: they have their own worker so
+# they never hold up the other previews
+github_worker = PreviewWorker()
+
+
 class MarkdownPreviewListener(sublime_plugin.EventListener):
     ''' auto update the output html if markdown file has already been converted once '''
 
-    def on_post_save(self, view):
-        settings = sublime.load_settings('MarkdownPreview.sublime-settings')
+    def is_previewed(self, view, settings):
         filetypes = settings.get('markdown_filetypes')
-        if filetypes and view.file_name().endswith(tuple(filetypes)):
-            temp_file = getTempMarkdownPreviewPath(view)
-            if os.path.isfile(temp_file):
-                # reexec markdown conversion
-                view.run_command('markdown_preview', {'target': 'disk'})
-                sublime.status_message('Markdown preview file updated')
+        filename = view.file_name()
+        if filetypes and filename and filename.endswith(tuple(filetypes)):
+            return os.path.isfile(getTempMarkdownPreviewPath(view))
+        return False
+
+    def on_post_save(self, view):
+        settings = get_settings()
+        if self.is_previewed(view, settings):
+            # reexec markdown conversion
+            view.run_command('markdown_preview', {'target': 'disk'})
+
+    def on_modified(self, view):
+        # called on every keystroke: only note the time if an update is already pending
+        update = live_preview_updates.get(view.id())
+        if update:
+            update[1] = time.time()
+            return
+        settings = get_settings()
+        if settings.get('live_preview') and self.is_previewed(view, settings):
+            now = time.time()
+            live_preview_updates[view.id()] = [now, now]
+            sublime.set_timeout(lambda: self.update_live_preview(view), settings.get('live_preview_idle', 300))
+
+    def update_live_preview(self, view):
+        ''' convert once typing paused for live_preview_idle ms, or at the latest
+            live_preview_debounce ms after the first modification '''
+        update = live_preview_updates.get(view.id())
+        if not update:
+            # closed in the meantime
+            return
+        settings = get_settings()
+        first, last = update
+        wait = min(last + settings.get('live_preview_idle', 300) / 1000.0,
+                   first + settings.get('live_preview_debounce', 1000) / 1000.0) - time.time()
+        if wait > 0:
+            sublime.set_timeout(lambda: self.update_live_preview(view), int(wait * 1000) + 1)
+            return
+        del live_preview_updates[view.id()]
+        view.run_command('markdown_preview', {'target': 'disk', 'live': True})
+
+    def on_close(self, view):
+        incremental_markdowners.pop(view.id(), None)
+        live_preview_updates.pop(view.id(), None)
 
 
 class MarkdownCheatsheetCommand(sublime_plugin.TextCommand):
@@ -107,8 +802,81 @@ class MarkdownCheatsheetCommand(sublime_plugin.TextCommand):
         sublime.status_message('Markdown cheat sheet opened')
 
 
-class MarkdownPreviewCommand(sublime_plugin.TextCommand):
-    ''' preview file contents with python-markdown and your web browser '''
+class MarkdownPreviewStatsCommand(sublime_plugin.ApplicationCommand):
+    ''' show Markdown Preview statistics in the status bar '''
+    def run(self):
+        stats = []
+        if render_cache:
+            stats.append(render_cache.stats())
+        if markdowner_pool.created:
+            stats.append(markdowner_pool.stats())
+        if http_pool.created:
+            stats.append(http_pool.stats())
+        if write_stats['written'] or write_stats['skipped']:
+            stats.append('preview files: %(written)d written, %(skipped)d unchanged writes skipped' % write_stats)
+        sublime.status_message('Markdown Preview %s' % ('; '.join(stats) or 'has no statistics yet'))
+
+
+class MarkdownPreviewJob(object):
+    ''' convert markdown and deliver the HTML to its target, on the preview worker thread
+
+        everything it needs from the view and the settings is read on the main thread
+        when it is created.
+    '''
+
+    # where the CSS and scripts are written when they are linked instead of inlined
+    assets_path = None
+
+    def __init__(self, view, settings, contents, target, live=False):
+        self.settings = get_settings_snapshot(settings)
+        self.contents = contents
+        self.target = target
+        self.live = live
+        self.view_id = view.id()
+        self.view_name = view.name()
+        self.file_name = view.file_name()
+        self.window = view.window()
+        self.key = (self.view_id, target)
+        self.worker = self.settings.get('parser') == 'github' and github_worker or preview_worker
+        if target in ['disk', 'browser']:
+            self.tmp_fullpath = getTempMarkdownPreviewPath(view)
+            if self.settings.get('external_assets'):
+                self.assets_path = os.path.join(os.path.dirname(self.tmp_fullpath), 'markdown-preview-assets')
+            self.livereload_installed = is_livereload_installed()
+
+    def load_head_file(self, filename):
+        ''' return the contents of filename, None if it doesn't exist, noting it in head_stamps '''
+        stamp, contents = load_cached_utf8(filename)
+        self.head_stamps.append((filename, stamp))
+        return contents
+
+    def write_asset(self, name, contents):
+        ''' write contents in assets_path under a name made unique by its hash, if not
+            already there, and return its URL relative to the preview file
+        '''
+        root, ext = os.path.splitext(os.path.basename(name))
+        digest = hashlib.sha1(contents.encode('utf-8')).hexdigest()[:16]
+        filename = '%s-%s%s' % (root, digest, ext)
+        path = os.path.join(self.assets_path, filename)
+        if not os.path.isfile(path):
+            if not os.path.isdir(self.assets_path):
+                os.makedirs(self.assets_path)
+            save_utf8(path, contents, self.settings.get('fsync_preview_files'))
+        # write it again if it goes away
+        self.head_stamps.append((path, file_stamp(path)))
+        return '%s/%s' % (os.path.basename(self.assets_path), filename)
+
+    def style(self, name, css):
+        ''' return the <style> for css, or a <link> to it with assets_path '''
+        if self.assets_path:
+            return u"<link href='%s' rel='stylesheet' type='text/css'>" % self.write_asset(name, css)
+        return u"<style>%s</style>" % css
+
+    def script(self, name, js):
+        ''' return the <script> for js, or one loading it with assets_path '''
+        if self.assets_path:
+            return u"<script src='%s'></script>" % self.write_asset(name, js)
+        return u"<script>%s</script>" % js
 
     def getCSsOnSearchPath(self):
         css_name = self.settings.get('css', 'default')
@@ -119,28 +887,30 @@ class MarkdownPreviewCommand(sublime_plugin.TextCommand):
             css_name = 'github.css' if self.settings.get('parser', 'default') == 'github' else 'markdown.css'
 
         # Try the local folder for css file.
-        mdfile = self.view.file_name()
+        mdfile = self.file_name
         if mdfile is not None:
             css_path = os.path.join(os.path.dirname(mdfile), css_name)
-            if os.path.isfile(css_path):
-                return u"<style>%s</style>" % load_utf8(css_path)
+            css = self.load_head_file(css_path)
+            if css is not None:
+                return self.style(css_path, css)
 
         # Try the build-in css files.
-        return u"<style>%s</style>" % load_resource(css_name)
+        return self.style(css_name, load_resource(css_name, self.head_stamps))
 
     def getOverrideCSS(self):
         ''' handls allow_css_overrides setting. '''
 
         if self.settings.get('allow_css_overrides'):
-            filename = self.view.file_name()
+            filename = self.file_name
             filetypes = self.settings.get('markdown_filetypes')
 
             if filename and filetypes:
                 for filetype in filetypes:
                     if filename.endswith(filetype):
                         css_filename = filename.rpartition(filetype)[0] + '.css'
-                        if (os.path.isfile(css_filename)):
-                            return u"<style>%s</style>" % load_utf8(css_filename)
+                        css = self.load_head_file(css_filename)
+                        if css is not None:
+                            return self.style(css_filename, css)
         return ''
 
     def getCSS(self):
@@ -151,7 +921,7 @@ class MarkdownPreviewCommand(sublime_plugin.TextCommand):
         ''' return the MathJax script if enabled '''
 
         if self.settings.get('enable_mathjax') is True:
-            return load_resource('mathjax.html')
+            return load_resource('mathjax.html', self.head_stamps)
         return ''
 
     def getHighlight(self):
@@ -159,42 +929,95 @@ class MarkdownPreviewCommand(sublime_plugin.TextCommand):
 
         highlight = ''
         if self.settings.get('enable_highlight') is True and self.settings.get('parser') == 'default':
-            highlight += "<style>%s</style>" % load_resource('highlight.css')
-            highlight += "<script>%s</script>" % load_resource('highlight.js')
+            highlight += self.style('highlight.css', load_resource('highlight.css', self.head_stamps))
+            highlight += self.script('highlight.js', load_resource('highlight.js', self.head_stamps))
             highlight += "<script>hljs.initHighlightingOnLoad();</script>"
         return highlight
 
+    def get_head(self):
+        ''' return the CSS and scripts of the <head>
 
-    def get_contents(self, region):
-        ''' Get contents or selection from view and optionally strip the YAML front matter '''
-        contents = self.view.substr(region)
-        # use selection if any
-        selection = self.view.substr(self.view.sel()[0])
-        if selection.strip() != '':
-            contents = selection
-        if self.settings.get('strip_yaml_front_matter') and contents.startswith('---'):
-            title = ''
-            title_match = re.search('(?:title:)(.+)', contents, flags=re.IGNORECASE)
-            if title_match:
-                stripped_title = title_match.group(1).strip()
-                title = '%s\n%s\n\n' % (stripped_title, '=' * len(stripped_title))
-            contents_without_front_matter = re.sub(r'(?s)^---.*---\n', '', contents)
-            contents = '%s%s' % (title, contents_without_front_matter)
-        return contents
+            kept in head_cache until one of the files it is made of, or could be made
+            of (like a .css override created later), changes.
+        '''
+        settings = self.settings
+        key = (self.file_name, self.assets_path, settings.get('css', 'default'), settings.get('parser', 'default'),
+               settings.get('allow_css_overrides'), tuple(settings.get('markdown_filetypes') or ()),
+               settings.get('enable_highlight'), settings.get('enable_mathjax'))
+        cached = head_cache.get(key)
+        if cached:
+            stamps, head = cached
+            if all(file_stamp(filename) == stamp for filename, stamp in stamps):
+                return head
+
+        self.head_stamps = []
+        head = self.getCSS() + self.getHighlight() + self.getMathJax()
+        if len(head_cache) >= HEAD_CACHE_SIZE:
+            head_cache.clear()
+        head_cache[key] = (self.head_stamps, head)
+        return head
+
+
+    def get_url_base(self):
+        ''' return the file:// url of the folder of the file, None if the view has no file '''
+        if self.file_name:
+            return u'file://%s/' % os.path.dirname(self.file_name)
+        return None
+
+    def get_url_resolver(self):
+        ''' return the markdown2 url_resolver fixing the relative urls of links and images '''
+        base = self.get_url_base()
+        if base is None:
+            return None
+        return lambda url: resolve_url(base, url)
 
     def postprocessor(self, html):
-        ''' fix relative paths in images, scripts, and links for the internal parser '''
+        ''' fix relative paths in images, scripts, and links for the internal parser
+
+            the urls of markdown links and images are already fixed by the url_resolver:
+            this is only needed for those of the HTML tags of the document.
+        '''
+        base = self.get_url_base()
+        if base is None:
+            return html
         def tag_fix(match):
             tag, src = match.groups()
-            filename = self.view.file_name()
-            if filename:
-                if not src.startswith(('file://', 'https://', 'http://', '/', '#')):
-                    abs_path = u'file://%s/%s' % (os.path.dirname(filename), src)
-                    tag = tag.replace(src, abs_path)
-            return tag
-        RE_SOURCES = re.compile("""(?P<tag><(?:img|script|a)[^>]+(?:src|href)=["'](?P<src>[^"']+)[^>]*>)""")
-        html = RE_SOURCES.sub(tag_fix, html)
-        return html
+            abs_path = resolve_url(base, src)
+            if abs_path is src:
+                return tag
+            start = match.start('src') - match.start()
+            return tag[:start] + abs_path + tag[start + len(src):]
+        return RE_SOURCES.sub(tag_fix, html)
+
+    def thumbnail_images(self, html):
+        ''' load the local images of the preview lazily, showing a thumbnail of the large ones
+
+            srcset lets the browser pick the original image instead where the thumbnail
+            would be too small: sizes tells it images are at most as wide as the 45em
+            body of markdown.css and github.css, not the whole window.
+        '''
+        path = os.path.join(os.path.dirname(self.tmp_fullpath), 'markdown-preview-thumbnails')
+        max_width = self.settings.get('image_thumbnail_width', 1200)
+        def img_fix(match):
+            tag = match.group(0)
+            if 'srcset=' in tag or 'loading=' in tag:
+                return tag
+            src = match.group(2)
+            attrs = ' loading="lazy"'
+            # the url of the image, percent-encoded or not, and with its & escaped
+            filename = urllib.unquote(src.replace('&amp;', '&').encode('utf-8')).decode('utf-8')
+            thumbnail = get_thumbnail(filename, path, max_width)
+            if thumbnail:
+                thumbnail, thumbnail_width, width = thumbnail
+                thumbnail = urllib.quote(thumbnail.encode('utf-8')).decode('utf-8')
+                # srcset urls are separated by spaces and commas
+                srcset_url = lambda url: u'file://%s' % url.replace(' ', '%20').replace(',', '%2C')
+                attrs += ' srcset="%s %dw, %s %dw" sizes="(max-width: 45em) 100vw, 45em"' % (
+                    srcset_url(thumbnail), thumbnail_width, srcset_url(src), width)
+                start, end = match.start(2) - match.start(), match.end(2) - match.start()
+                tag = tag[:start] + thumbnail + tag[end:]
+            return tag[:4] + attrs + tag[4:]
+        return RE_LOCAL_IMG.sub(img_fix, html)
 
     def get_config_extensions(self, default_extensions):
         config_extensions = self.settings.get('enabled_extensions')
@@ -205,94 +1028,206 @@ class MarkdownPreviewCommand(sublime_plugin.TextCommand):
             config_extensions.extend( default_extensions )
         return config_extensions
 
+    def get_incremental_markdowner(self, extras):
+        ''' return the IncrementalMarkdown instance of this view, for the given extras
+            and the folder of its file
+        '''
+        key = (frozenset(extras), self.get_url_base())
+        markdowner_key, markdowner = incremental_markdowners.get(self.view_id, (None, None))
+        if markdowner_key != key:
+            markdowner = markdown2.IncrementalMarkdown(extras=list(extras), url_resolver=self.get_url_resolver())
+            incremental_markdowners[self.view_id] = (key, markdowner)
+        return markdowner
+
+    def get_enabled_extras(self):
+        ''' return the set of markdown2 extras to use with the builtin parser '''
+        enabled_extras = set(self.get_config_extensions(['footnotes', 'toc', 'fenced-code-blocks', 'cuddled-lists']))
+        if self.settings.get("enable_mathjax") is True or self.settings.get("enable_highlight") is True:
+            enabled_extras.add('code-friendly')
+        return enabled_extras
+
     def convert_markdown(self, markdown_text):
         ''' convert input markdown to HTML, with github or builtin parser '''
         config_parser = self.settings.get('parser')
-        github_oauth_token = self.settings.get('github_oauth_token')
+        if config_parser and config_parser == 'github':
+            cache_key = ['github'] + self.get_github_key()
+        else:
+            enabled_extras = self.get_enabled_extras()
+            # the postprocessor output depends on the location of the file
+            filename = self.file_name
+            cache_key = ['default', markdown2.__version__, sorted(enabled_extras),
+                         filename and os.path.dirname(filename)]
+
+        cache = get_render_cache(self.settings)
+        # the preview written on every save or live update is converted from a
+        # document being edited: it would only fill the cache with stale entries,
+        # and hardly ever be found in it
+        use_cache = cache and self.target != 'disk'
+        if use_cache:
+            cache_key = cache.key(markdown_text, *cache_key)
+            cached = cache.get(cache_key)
+            if cached:
+                return cached['html']
 
-        markdown_html = u'cannot convert markdown'
         if config_parser and config_parser == 'github':
-            # use the github API
-            sublime.status_message('converting markdown with github API...')
-            try:
-                github_mode = self.settings.get('github_mode', 'gfm')
-                data = {
-                    "text": markdown_text,
-                    "mode": github_mode
-                }
-                headers = {
-                    'Content-Type': 'application/json'
-                }
-                if github_oauth_token:
-                    headers['Authorization'] = "token %s" % github_oauth_token
-                data = json.dumps(data).encode('utf-8')
-                url = "https://api.github.com/markdown"
-                sublime.status_message(url)
-                request = urllib2.Request(url, data, headers)
-                markdown_html = urllib2.urlopen(request).read().decode('utf-8')
-            except urllib2.HTTPError, e:
-                if e.code == 401:
-                    sublime.error_message('github API auth failed. Please check your OAuth token.')
-                else:
-                    sublime.error_message('github API responded in an unfashion way :/')
-            except urllib2.URLError:
-                sublime.error_message('cannot use github API to convert markdown. SSL is not included in your Python installation')
-            except:
-                sublime.error_message('cannot use github API to convert markdown. Please check your settings.')
+            if cache and self.settings.get('github_chunked'):
+                markdown_html = self.convert_markdown_with_github_chunked(markdown_text, cache)
             else:
-                sublime.status_message('converted markdown with github API successfully')
+                markdown_html = self.convert_markdown_with_github(markdown_text)
+            if markdown_html is None:
+                return u'cannot convert markdown'
         else:
-            # convert the markdown
-            enabled_extras = set(self.get_config_extensions(['footnotes', 'toc', 'fenced-code-blocks', 'cuddled-lists']))
-            if self.settings.get("enable_mathjax") is True or self.settings.get("enable_highlight") is True:
-                enabled_extras.add('code-friendly')
-            markdown_html = markdown2.markdown(markdown_text, extras=list(enabled_extras))
-            toc_html = markdown_html.toc_html
-            if toc_html:
-                toc_markers = ['[toc]', '[TOC]', '<!--TOC-->']
-                for marker in toc_markers:
-                    markdown_html = markdown_html.replace(marker, toc_html)
-
-            # postprocess the html from internal parser
+            markdown_html = self.convert_markdown_with_markdown2(markdown_text, enabled_extras)
+
+        if use_cache:
+            cache.set(cache_key, {'html': markdown_html})
+        return markdown_html
+
+    def get_github_key(self):
+        ''' return what a github API conversion depends on besides the text
+
+            the token is identified by its hash, it is not written in the cache.
+        '''
+        token = self.settings.get('github_oauth_token')
+        return [
+            self.settings.get('github_mode', 'gfm'),
+            self.settings.get('github_api_url', 'https://api.github.com/markdown'),
+            token and hashlib.sha1(token.encode('utf-8')).hexdigest(),
+        ]
+
+    def convert_markdown_with_github_chunked(self, markdown_text, cache):
+        ''' convert input markdown to HTML with the github API a section at a time,
+            return None on failure
+
+            only the sections missing from the render cache are sent, with the link
+            definitions of the whole document so their references still resolve.
+        '''
+        definitions = u''.join(LINK_DEFINITION_RE.findall(markdown_text))
+        github_key = self.get_github_key()
+        html_parts = []
+        for section in split_sections(markdown_text):
+            key = cache.key(section, definitions, 'github-section', *github_key)
+            cached = cache.get(key)
+            if cached:
+                html_parts.append(cached['html'])
+                continue
+            html = self.convert_markdown_with_github(u'%s\n\n%s' % (section, definitions))
+            if html is None:
+                return None
+            cache.set(key, {'html': html})
+            html_parts.append(html)
+        return u'\n'.join(html_parts)
+
+    def convert_markdown_with_github(self, markdown_text):
+        ''' convert input markdown to HTML with the github API, return None on failure '''
+        github_oauth_token = self.settings.get('github_oauth_token')
+
+        markdown_html = None
+        # use the github API
+        main_thread(sublime.status_message, 'converting markdown with github API...')
+        try:
+            github_mode = self.settings.get('github_mode', 'gfm')
+            data = {
+                "text": markdown_text,
+                "mode": github_mode
+            }
+            headers = {
+                'Content-Type': 'application/json'
+            }
+            if github_oauth_token:
+                headers['Authorization'] = "token %s" % github_oauth_token
+            data = json.dumps(data).encode('utf-8')
+            url = self.settings.get('github_api_url', 'https://api.github.com/markdown')
+            timeout = self.settings.get('github_api_timeout', 20)
+            main_thread(sublime.status_message, url)
+            status, body = http_pool.request('POST', url, data, headers, timeout)
+        except socket.timeout:
+            main_thread(sublime.error_message, 'github API did not answer in %s seconds. Please try again later.' % timeout)
+        except (socket.error, httplib.HTTPException), e:
+            main_thread(sublime.error_message, 'cannot use github API to convert markdown: %s' % e)
+        except:
+            main_thread(sublime.error_message, 'cannot use github API to convert markdown. Please check your settings.')
+        else:
+            if status == 200:
+                markdown_html = body.decode('utf-8')
+                main_thread(sublime.status_message, 'converted markdown with github API successfully')
+            elif status == 401:
+                main_thread(sublime.error_message, 'github API auth failed. Please check your OAuth token.')
+            else:
+                main_thread(sublime.error_message, 'github API responded in an unfashion way :/')
+        return markdown_html
+
+    def convert_markdown_with_markdown2(self, markdown_text, enabled_extras):
+        ''' convert input markdown to HTML with the builtin parser, the TOC replacing its markers '''
+        if self.settings.get('incremental_conversion'):
+            markdowner = self.get_incremental_markdowner(enabled_extras)
+            markdown_html = markdowner.convert(markdown_text)
+        else:
+            markdown_html = markdowner_pool.convert(markdown_text, enabled_extras,
+                                                    url_resolver=self.get_url_resolver())
+        toc_html = markdown_html.toc_html
+        if toc_html:
+            toc_markers = ['[toc]', '[TOC]', '<!--TOC-->']
+            for marker in toc_markers:
+                markdown_html = markdown_html.replace(marker, toc_html)
+
+        # postprocess the html from internal parser, if the document has tags to fix
+        if RE_SOURCES_TAG.search(markdown_text):
             markdown_html = self.postprocessor(markdown_html)
 
         return markdown_html
 
     def get_title(self):
-        title = self.view.name()
+        title = self.view_name
         if not title:
-            fn = self.view.file_name()
+            fn = self.file_name
             title = 'untitled' if not fn else os.path.splitext(os.path.basename(fn))[0]
         return '<title>%s</title>' % title
 
-    def run(self, edit, target='browser'):
-        self.settings = sublime.load_settings('MarkdownPreview.sublime-settings')
-        region = sublime.Region(0, self.view.size())
-
-        contents = self.get_contents(region)
+    def get_html_parts(self, markdown_html):
+        ''' return the parts of the complete HTML document around the converted markdown
 
-        markdown_html = self.convert_markdown(contents)
+            the document is written from this list of parts: it is only joined for
+            the clipboard.
+        '''
+        return [
+            u'<!DOCTYPE html>',
+            u'<html><head><meta charset="utf-8">',
+            self.get_head(),
+            self.get_title(),
+            u'</head><body>',
+            markdown_html,
+            u'</body>',
+            u'</html>',
+        ]
 
-        full_html = u'<!DOCTYPE html>'
-        full_html += '<html><head><meta charset="utf-8">'
-        full_html += self.getCSS()
-        full_html += self.getHighlight()
-        full_html += self.getMathJax()
-        full_html += self.get_title()
-        full_html += '</head><body>'
-        full_html += markdown_html
-        full_html += '</body>'
-        full_html += '</html>'
+    def run(self):
+        markdown_html = self.convert_markdown(self.contents)
+        if self.worker.superseded(self):
+            # a newer conversion of this view is on its way
+            return
 
+        target = self.target
         if target in ['disk', 'browser']:
-            # check if LiveReload ST2 extension installed and add its script to the resulting HTML
-            livereload_installed = ('LiveReload' in os.listdir(sublime.packages_path()))
-            # build the html
-            if livereload_installed:
-                full_html += '<script>document.write(\'<script src="http://\' + (location.host || \'localhost\').split(\':\')[0] + \':35729/livereload.js?snipver=1"></\' + \'script>\')</script>'
+            if self.settings.get('image_thumbnails') and '<img' in markdown_html:
+                markdown_html = self.thumbnail_images(markdown_html)
+            html_parts = self.get_html_parts(markdown_html)
+            # add the LiveReload script to the resulting HTML
+            if self.livereload_installed:
+                html_parts.append('<script>document.write(\'<script src="http://\' + (location.host || \'localhost\').split(\':\')[0] + \':35729/livereload.js?snipver=1"></\' + \'script>\')</script>')
             # update output html file
-            tmp_fullpath = getTempMarkdownPreviewPath(self.view)
-            save_utf8(tmp_fullpath, full_html)
+            tmp_fullpath = self.tmp_fullpath
+            digest = utf8_digest(html_parts)
+            written = written_digests.get(tmp_fullpath)
+            unchanged = written and written == (digest, file_stamp(tmp_fullpath))
+            if unchanged:
+                write_stats['skipped'] += 1
+                if self.live:
+                    return
+            else:
+                save_utf8(tmp_fullpath, html_parts, self.settings.get('fsync_preview_files'))
+                written_digests[tmp_fullpath] = (digest, file_stamp(tmp_fullpath))
+                write_stats['written'] += 1
             # now opens in browser if needed
             if target == 'browser':
                 config_browser = self.settings.get('browser')
@@ -304,17 +1239,54 @@ class MarkdownPreviewCommand(sublime_plugin.TextCommand):
                         cmd += ' &'
                     result = os.system(cmd)
                     if result != 0:
-                        sublime.error_message('cannot execute "%s" Please check your Markdown Preview settings' % config_browser)
+                        main_thread(sublime.error_message, 'cannot execute "%s" Please check your Markdown Preview settings' % config_browser)
                     else:
-                        sublime.status_message('Markdown preview launched in %s' % config_browser)
+                        main_thread(sublime.status_message, 'Markdown preview launched in %s' % config_browser)
                 else:
-                    desktop.open(tmp_fullpath)
-                    sublime.status_message('Markdown preview launched in default html viewer')
+                    desktop.open(tmp_fullpath, persistent=self.settings.get('persistent_opener'))
+                    main_thread(sublime.status_message, 'Markdown preview launched in default html viewer')
+            elif unchanged:
+                main_thread(sublime.status_message, 'Markdown preview file unchanged')
+            elif not self.live:
+                main_thread(sublime.status_message, 'Markdown preview file updated')
         elif target == 'sublime':
             # create a new buffer and paste the output HTML
-            new_scratch_view(self.view.window(), markdown_html)
-            sublime.status_message('Markdown preview launched in sublime')
+            main_thread(new_scratch_view, self.window, markdown_html)
+            main_thread(sublime.status_message, 'Markdown preview launched in sublime')
         elif target == 'clipboard':
             # clipboard copy the full HTML
-            sublime.set_clipboard(full_html)
-            sublime.status_message('Markdown export copied to clipboard')
+            main_thread(sublime.set_clipboard, u''.join(self.get_html_parts(markdown_html)))
+            main_thread(sublime.status_message, 'Markdown export copied to clipboard')
+
+
+class MarkdownPreviewCommand(sublime_plugin.TextCommand):
+    ''' preview file contents with python-markdown and your web browser
+
+        the view contents are read here, the conversion runs on the preview worker thread.
+    '''
+
+    def get_contents(self, region):
+        ''' Get contents or selection from view and optionally strip the YAML front matter '''
+        contents = self.view.substr(region)
+        # use selection if any
+        selection = self.view.substr(self.view.sel()[0])
+        if selection.strip() != '':
+            contents = selection
+        if self.settings.get('strip_yaml_front_matter') and contents.startswith('---'):
+            title = ''
+            title_match = re.search('(?:title:)(.+)', contents, flags=re.IGNORECASE)
+            if title_match:
+                stripped_title = title_match.group(1).strip()
+                title = '%s\n%s\n\n' % (stripped_title, '=' * len(stripped_title))
+            contents_without_front_matter = re.sub(r'(?s)^---.*---\n', '', contents)
+            contents = '%s%s' % (title, contents_without_front_matter)
+        return contents
+
+    def run(self, edit, target='browser', live=False):
+        self.settings = get_settings()
+        region = sublime.Region(0, self.view.size())
+
+        contents = self.get_contents(region)
+
+        job = MarkdownPreviewJob(self.view, self.settings, contents, target, live)
+        job.worker.submit(job)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark suite for markdown2 and the preview pipeline.
+
+Usage, from the package folder:
+
+    python bench/run.py                   # run, compare against bench/baseline.json
+    python bench/run.py -o results.json   # also write the results
+    python bench/run.py --save-baseline   # record the results as the new baseline
+    python bench/run.py -k lists          # only the cases matching 'lists'
+
+Every corpus is converted with no extras, with each extra the preview enables
+on its own, and with all of them together; some also with the extras they
+exercise (see CORPUS_CONFIGS). Under Python 2, the Sublime Text 2
+runtime, the preview postprocessor and the assembly and UTF-8 encoding of the
+HTML document are timed too.
+
+Each case runs in a fresh interpreter, so its peak memory (max RSS) is its own.
+The run fails (exit status 1) when a case is slower, or uses more memory, than
+its baseline by more than the tolerance. Baselines are recorded per Python
+major version and are only meaningful on the machine that recorded them.
+"""
+
+import os
+import sys
+import json
+import time
+import subprocess
+from optparse import OptionParser, SUPPRESS_HELP
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, PACKAGE_DIR)
+# time fenced code blocks the way the preview converts them: the Python
+# embedded in Sublime Text has no pygments
+sys.modules['pygments'] = None
+
+import markdown2
+
+PY2 = sys.version_info[0] == 2
+
+# the extras enabled by MarkdownPreviewJob.get_enabled_extras()
+PREVIEW_EXTRAS = ['footnotes', 'toc', 'fenced-code-blocks', 'cuddled-lists', 'code-friendly']
+
+CONFIGS = [('none', [])] + [(extra, [extra]) for extra in PREVIEW_EXTRAS] + [('preview', PREVIEW_EXTRAS)]
+
+# the extras a corpus is also converted with, which the preview doesn't enable
+CORPUS_CONFIGS = {
+    'tables': [('tables', ['tables']), ('wiki-tables', ['wiki-tables']), ('gfm', ['gfm'])],
+}
+
+
+def read(name):
+    f = open(os.path.join(PACKAGE_DIR, name), 'rb')
+    try:
+        return f.read().decode('utf-8')
+    finally:
+        f.close()
+
+
+def lists_corpus(n=400):
+    parts = []
+    for i in range(n):
+        parts.append(u'- item %d with *emphasis*\n'
+                     u'- second item\n'
+                     u'    - nested `code`\n'
+                     u'        1. deeper\n'
+                     u'        2. deeper still\n'
+                     u'    - back up\n'
+                     u'- last item\n\n'
+                     u'A paragraph between lists %d.\n\n'
+                     u'1. first\n'
+                     u'2. second\n\n'
+                     u'    with a second paragraph\n\n' % (i, i))
+    return u''.join(parts)
+
+
+def tables_corpus(n=150):
+    parts = []
+    for i in range(n):
+        parts.append(u'Table %d\n\n| Name | Value | Notes |\n|------|------:|:------|\n' % i)
+        for j in range(10):
+            parts.append(u'| row %d | %d | some *text* and `code` |\n' % (j, i * j))
+        parts.append(u'\n|| wiki || table || %d ||\n|| a || b || c ||\n\n' % i)
+    return u''.join(parts)
+
+
+def code_fences_corpus(n=300):
+    parts = []
+    for i in range(n):
+        parts.append(u'Some text before block %d.\n\n'
+                     u'```python\n'
+                     u'def f%d(x):\n'
+                     u'    return [y * 2 for y in x if y > %d]  # <not html> & *not em*\n'
+                     u'```\n\n'
+                     u'    indented code %d\n'
+                     u'    with `backticks` and <tags>\n\n' % (i, i, i, i))
+    return u''.join(parts)
+
+
+def links_corpus(n=400):
+    parts = []
+    for i in range(n):
+        parts.append(u'See [inline %d](http://example.com/%d "title %d"), [ref][r%d], '
+                     u'![image](img/%d.png), <http://example.org/%d> and <me%d@example.com>. '
+                     u'A footnote[^f%d] too.\n\n' % (i, i, i, i, i, i, i, i))
+    for i in range(n):
+        parts.append(u'[r%d]: http://example.net/%d "ref %d"\n' % (i, i, i))
+    parts.append(u'\n')
+    for i in range(n):
+        parts.append(u'[^f%d]: Footnote %d.\n\n' % (i, i))
+    return u''.join(parts)
+
+
+def html_corpus(n=300):
+    parts = []
+    for i in range(n):
+        parts.append(u'<div class="note">\n<p>Block %d &amp; <b>bold</b></p>\n</div>\n\n'
+                     u'Text with <span class="x">inline %d</span>, <br/> and a '
+                     u'<a href="page%d.html">link</a>.\n\n'
+                     u'<!-- comment %d -->\n\n'
+                     u'<table><tr><td>%d</td></tr></table>\n\n' % (i, i, i, i, i))
+    return u''.join(parts)
+
+
+CORPORA = {
+    'sample': lambda: read('sample.md') * 40,
+    'readme': lambda: read('README.md') * 40,
+    'lists': lists_corpus,
+    'tables': tables_corpus,
+    'code-fences': code_fences_corpus,
+    'links': links_corpus,
+    'html': html_corpus,
+}
+
+
+def get_cases():
+    ''' return the case names: corpus/stage '''
+    cases = []
+    for corpus in sorted(CORPORA):
+        for config, extras in CONFIGS + CORPUS_CONFIGS.get(corpus, []):
+            cases.append('%s/markdown2-%s' % (corpus, config))
+        if PY2:
+            cases.append('%s/postprocessor' % corpus)
+            cases.append('%s/full_html' % corpus)
+    return cases
+
+
+def get_preview_job():
+    ''' return a MarkdownPreviewJob for a file in the package folder
+
+        MarkdownPreview.py runs inside Sublime Text: the few sublime calls made at
+        import time are answered here so the pipeline can be timed on its own.
+    '''
+    import types
+    import atexit
+    import shutil
+    import tempfile
+    sublime = types.ModuleType('sublime')
+    packages = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, packages, True)
+    os.symlink(PACKAGE_DIR, os.path.join(packages, 'Markdown Preview'))
+    sublime.version = lambda: '2221'
+    sublime.packages_path = lambda: packages
+    sublime_plugin = types.ModuleType('sublime_plugin')
+    for name in ('EventListener', 'ApplicationCommand', 'WindowCommand', 'TextCommand'):
+        setattr(sublime_plugin, name, object)
+    sys.modules['sublime'] = sublime
+    sys.modules['sublime_plugin'] = sublime_plugin
+    import MarkdownPreview
+
+    job = MarkdownPreview.MarkdownPreviewJob.__new__(MarkdownPreview.MarkdownPreviewJob)
+    job.settings = {'enable_highlight': True, 'parser': 'default'}
+    job.file_name = os.path.join(PACKAGE_DIR, 'bench.md')
+    job.view_name = ''
+    return job
+
+
+def time_case(case, min_time=0.5, min_runs=3):
+    ''' time one case in this process, return its results '''
+    corpus, stage = case.split('/')
+    text = CORPORA[corpus]()
+    if stage.startswith('markdown2-'):
+        extras = dict(CONFIGS + CORPUS_CONFIGS.get(corpus, []))[stage[len('markdown2-'):]]
+        func = lambda: markdown2.markdown(text, extras=extras)
+    else:
+        job = get_preview_job()
+        import MarkdownPreview
+        html = markdown2.markdown(text, extras=PREVIEW_EXTRAS)
+        if stage == 'postprocessor':
+            func = lambda: job.postprocessor(html)
+        else:
+            def func():
+                # assemble and encode the document the way it is written
+                for chunk in MarkdownPreview.utf8_chunks(job.get_html_parts(html)):
+                    pass
+    func()  # warm up: imports, regex compilation
+
+    times = []
+    start = time.time()
+    while len(times) < min_runs or time.time() - start < min_time:
+        t = time.time()
+        func()
+        times.append(time.time() - t)
+
+    size = len(text.encode('utf-8'))
+    best = min(times)
+    result = {
+        'bytes': size,
+        'runs': len(times),
+        'seconds': best,
+        'mb_per_s': size / best / 1e6,
+        'peak_mb': None,
+    }
+    if resource:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on mac
+        result['peak_mb'] = peak / (1e6 if sys.platform == 'darwin' else 1e3)
+    return result
+
+
+def run_case(case):
+    ''' time one case in a fresh interpreter '''
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', case])
+    return json.loads(output.decode('utf-8'))
+
+
+def compare(results, baseline, tolerance):
+    ''' return the regressions of results against baseline, as messages '''
+    regressions = []
+    for case in sorted(results):
+        if case not in baseline:
+            continue
+        now, then = results[case], baseline[case]
+        if now['mb_per_s'] < then['mb_per_s'] * (1 - tolerance):
+            regressions.append('%s: %.2f MB/s, baseline %.2f MB/s'
+                               % (case, now['mb_per_s'], then['mb_per_s']))
+        if now['peak_mb'] and then.get('peak_mb') and now['peak_mb'] > then['peak_mb'] * (1 + tolerance):
+            regressions.append('%s: peak %.1f MB, baseline %.1f MB'
+                               % (case, now['peak_mb'], then['peak_mb']))
+    return regressions
+
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', help='write the results to this JSON file')
+    parser.add_option('-b', '--baseline', default=os.path.join(BENCH_DIR, 'baseline.json'),
+                      help='baseline JSON file (default: %default)')
+    parser.add_option('--save-baseline', action='store_true',
+                      help='store the results in the baseline file instead of comparing')
+    parser.add_option('-t', '--tolerance', type='float', default=0.3,
+                      help='allowed slow down or memory growth, as a fraction (default: %default)')
+    parser.add_option('-k', dest='filter', help='only run the cases containing this string')
+    parser.add_option('--child', help=SUPPRESS_HELP)
+    opts, args = parser.parse_args(argv[1:])
+
+    if opts.child:
+        sys.stdout.write(json.dumps(time_case(opts.child)))
+        return 0
+
+    key = 'py%d' % sys.version_info[0]
+    results = {}
+    for case in get_cases():
+        if opts.filter and opts.filter not in case:
+            continue
+        result = results[case] = run_case(case)
+        print('%-40s %8.2f MB/s %9.2f ms %8s MB peak' % (
+            case, result['mb_per_s'], result['seconds'] * 1000,
+            result['peak_mb'] and '%.1f' % result['peak_mb']))
+
+    report = {
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'markdown2': markdown2.__version__,
+        'results': results,
+    }
+    if opts.output:
+        f = open(opts.output, 'w')
+        json.dump(report, f, indent=2, sort_keys=True, separators=(',', ': '))
+        f.close()
+
+    baselines = {}
+    if os.path.isfile(opts.baseline):
+        f = open(opts.baseline)
+        baselines = json.load(f)
+        f.close()
+    if opts.save_baseline:
+        baselines.setdefault(key, {}).update(results)
+        f = open(opts.baseline, 'w')
+        json.dump(baselines, f, indent=2, sort_keys=True, separators=(',', ': '))
+        f.close()
+        print('baseline saved to %s' % opts.baseline)
+        return 0
+
+    if key not in baselines:
+        print('no %s baseline in %s, nothing to compare' % (key, opts.baseline))
+        return 0
+    regressions = compare(results, baselines[key], opts.tolerance)
+    for regression in regressions:
+        print('REGRESSION %s' % regression)
+    return regressions and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -29,6 +29,11 @@ To detect a specific desktop environment, use the get_desktop function.
 To detect whether the desktop environment is standardised (according to the
 proposed DESKTOP_LAUNCH standard), use the is_standard function.
 
+The detected environment is remembered for the life of the process, since
+detecting XFCE involves running a program. Use the forget_desktop function to
+have the next call detect it again, for example after the environment variables
+have been changed.
+
 Opening URLs
 ------------
 
@@ -44,6 +49,14 @@ desktop.open("http://www.python.org", "KDE") # Insists on KDE
 desktop.open("http://www.python.org", "GNOME") # Insists on GNOME
 desktop.open("http://www.python.org", "MATE") # Insists on MATE
 
+To open many URLs without starting a new shell or opener from this process each
+time, specify the persistent parameter to the open function:
+
+desktop.open("http://www.python.org", persistent=1)
+
+The opener is then started by a shell kept running in the background, and no
+process identifier is returned.
+
 Without overriding using the desktop parameter, the open function will attempt
 to use the "standard" desktop opening mechanism which is controlled by the
 DESKTOP_LAUNCH environment variable as described below.
@@ -98,6 +111,21 @@ try:
         opener.wait()
         return opener.returncode == 0
 
+    _launcher = []
+
+    def _launch(cmd):
+        for attempt in (0, 1):
+            if not _launcher or _launcher[0].poll() is not None:
+                _launcher[:] = [subprocess.Popen("/bin/sh", stdin=subprocess.PIPE, close_fds=True)]
+            try:
+                _launcher[0].stdin.write(cmd + " &\n")
+                _launcher[0].stdin.flush()
+                return None
+            except (IOError, OSError):
+                # The shell has gone away: start another one.
+                del _launcher[:]
+        raise OSError, "Cannot start a shell to launch '%s'" % cmd
+
 except ImportError:
     import popen2
     def _run(cmd, shell, wait):
@@ -116,6 +144,8 @@ except ImportError:
         opener.wait()
         return opener.poll() == 0
 
+    _launch = None
+
 import commands
 
 # Private functions.
@@ -146,6 +176,10 @@ def _is_x11():
 
     return os.environ.has_key("DISPLAY")
 
+# The detected desktop environment, if any detection has been done.
+
+_detected = []
+
 # Introspection functions.
 
 def get_desktop():
@@ -153,8 +187,28 @@ def get_desktop():
     """
     Detect the current desktop environment, returning the name of the
     environment. If no environment could be detected, None is returned.
+
+    The environment is only detected once: later calls return the same name
+    until the forget_desktop function is called.
     """
 
+    if not _detected:
+        _detected.append(_detect_desktop())
+    return _detected[0]
+
+def forget_desktop():
+
+    """
+    Forget the detected desktop environment, so that it is detected again by
+    the next call to get_desktop, use_desktop or open.
+    """
+
+    del _detected[:]
+
+def _detect_desktop():
+
+    "Detect the current desktop environment, as described in get_desktop."
+
     if os.environ.has_key("KDE_FULL_SESSION") or \
         os.environ.has_key("KDE_MULTIHEAD"):
         return "KDE"
@@ -226,7 +280,7 @@ def is_standard():
 
 # Activity functions.
 
-def open(url, desktop=None, wait=0):
+def open(url, desktop=None, wait=0, persistent=0):
 
     """
     Open the 'url' in the current desktop's preferred file browser. If the
@@ -248,14 +302,22 @@ def open(url, desktop=None, wait=0):
     'wait' is set to a true value, this function will wait for the launching
     mechanism to complete before returning (as opposed to immediately returning
     as is the default behaviour).
+
+    If the optional 'persistent' parameter is set to a true value, the opener
+    is started by a shell kept running for that purpose instead of a new
+    process started from this one, and None is returned. This is not done on
+    Windows or when 'wait' is set to a true value.
     """
 
     # Decide on the desktop environment in use.
 
     desktop_in_use = use_desktop(desktop)
+    persistent = persistent and not wait and _launch is not None
 
     if desktop_in_use == "standard":
         arg = "".join([os.environ["DESKTOP_LAUNCH"], commands.mkarg(url)])
+        if persistent:
+            return _launch(arg)
         return _run(arg, 1, wait)
 
     elif desktop_in_use == "Windows":
@@ -288,6 +350,8 @@ def open(url, desktop=None, wait=0):
     else:
         raise OSError, "Desktop '%s' not supported (neither DESKTOP_LAUNCH nor os.startfile could be used)" % desktop_in_use
 
+    if persistent:
+        return _launch("".join(map(commands.mkarg, cmd)).lstrip())
     return _run(cmd, 0, wait)
 
 # vim: tabstop=4 expandtab shiftwidth=4
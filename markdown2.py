@@ -42,6 +42,8 @@ text-to-HTML conversion tool for web writers.
 Supported extra syntax options (see -x|--extras option below and
 see <https://github.com/trentm/python-markdown2/wiki/Extras> for details):
 
+* autolink-urls: Turn bare 'http://', 'https://' and 'www.' URLs into links,
+  as GitHub-flavored Markdown does.
 * code-friendly: Disable _ and __ for em and strong.
 * cuddled-lists: Allow lists to be cuddled to the preceding paragraph.
 * fenced-code-blocks: Allows a code block to not have to be indented
@@ -50,6 +52,9 @@ see <https://github.com/trentm/python-markdown2/wiki/Extras> for details):
   syntax highlighting.
 * footnotes: Support footnotes as in use on daringfireball.net and
   implemented in other Markdown processors (tho not in Markdown.pl v1.0.1).
+* gfm: GitHub-flavored Markdown. Turns on fenced-code-blocks (which can
+  then also be fenced with '~~~'), tables, task-lists, strike and
+  autolink-urls. See <https://help.github.com/articles/github-flavored-markdown>.
 * header-ids: Adds "id" attributes to headers. The id value is a slug of
   the header text.
 * html-classes: Takes a dict mapping html tag names (lowercase) to a
@@ -70,6 +75,12 @@ see <https://github.com/trentm/python-markdown2/wiki/Extras> for details):
 * smarty-pants: Replaces ' and " with curly quotation marks or curly
   apostrophes.  Replaces --, ---, ..., and . . . with en dashes, em dashes,
   and ellipses.
+* strike: Text between '~~' is struck through: <del>.
+* tables: Tables of '|'-separated cells, as in GitHub-flavored Markdown,
+  with a '---' line under the header row. Colons in that line align the
+  columns.
+* task-lists: List items starting with '[ ]' or '[x]' get a checkbox, as
+  in GitHub-flavored Markdown.
 * toc: The returned HTML string gets a new "toc_html" attribute which is
   a Table of Contents for the document. (experimental)
 * xml: Passes one-liner processing instructions and namespaced XML tags.
@@ -91,13 +102,11 @@ import sys
 from pprint import pprint
 import re
 import logging
-try:
-    from hashlib import md5
-except ImportError:
-    from md5 import md5
 import optparse
+import time
 from random import random, randint
 import codecs
+from hashlib import sha1
 
 
 #---- Python version compat
@@ -136,13 +145,22 @@ log = logging.getLogger("markdown")
 DEFAULT_TAB_WIDTH = 4
 
 
-SECRET_SALT = bytes(randint(0, 1000000))
-def _hash_text(s):
-    return 'md5-' + md5(SECRET_SALT + s.encode("utf-8")).hexdigest()
+# Parts of the text that must be kept from further processing are
+# "hashed": swapped out for a key made of a prefix unique to this process
+# and their index in the converter's table of hashed strings (see
+# `Markdown._hash_text()`). The keys are made of word characters (and a
+# '-') so the span regexes treat them like text.
+SECRET_SALT = "%x" % randint(0x10000000, 0xffffffff)
+_hash_key_fmt = "h%s-%%dh" % SECRET_SALT
+_hash_key_re = re.compile(r"h%s-(\d+)h" % SECRET_SALT)
+
+# The escaped characters are the first entries in every table of hashed
+# strings, the quotes only being escaped with the "smarty-pants" extra.
+g_escaped_chars = '\\`*_{}[]()>#+-.!"\''
 
 # Table of hash values for escaped characters:
-g_escape_table = dict([(ch, _hash_text(ch))
-    for ch in '\\`*_{}[]()>#+-.!'])
+g_escape_table = dict([(ch, _hash_key_fmt % i)
+    for i, ch in enumerate(g_escaped_chars[:-2])])
 
 
 
@@ -158,22 +176,30 @@ class MarkdownError(Exception):
 def markdown_path(path, encoding="utf-8",
                   html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
                   safe_mode=None, extras=None, link_patterns=None,
-                  use_file_vars=False):
+                  use_file_vars=False, span_tokenizer=False, profile=False,
+                  url_resolver=None):
     fp = codecs.open(path, 'r', encoding)
     text = fp.read()
     fp.close()
     return Markdown(html4tags=html4tags, tab_width=tab_width,
                     safe_mode=safe_mode, extras=extras,
                     link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+                    use_file_vars=use_file_vars,
+                    span_tokenizer=span_tokenizer,
+                    profile=profile,
+                    url_resolver=url_resolver).convert(text)
 
 def markdown(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
              safe_mode=None, extras=None, link_patterns=None,
-             use_file_vars=False):
+             use_file_vars=False, span_tokenizer=False, profile=False,
+             url_resolver=None):
     return Markdown(html4tags=html4tags, tab_width=tab_width,
                     safe_mode=safe_mode, extras=extras,
                     link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+                    use_file_vars=use_file_vars,
+                    span_tokenizer=span_tokenizer,
+                    profile=profile,
+                    url_resolver=url_resolver).convert(text)
 
 class Markdown(object):
     # The dict of "extras" to enable in processing -- a mapping of
@@ -196,8 +222,13 @@ class Markdown(object):
 
     _ws_only_line_re = re.compile(r"^[ \t]+$", re.M)
 
+    # The extras turned on by the "gfm" (GitHub-flavored Markdown) extra.
+    _gfm_extras = ["fenced-code-blocks", "tables", "task-lists", "strike",
+                   "autolink-urls"]
+
     def __init__(self, html4tags=False, tab_width=4, safe_mode=None,
-                 extras=None, link_patterns=None, use_file_vars=False):
+                 extras=None, link_patterns=None, use_file_vars=False,
+                 span_tokenizer=False, profile=False, url_resolver=None):
         if html4tags:
             self.empty_element_suffix = ">"
         else:
@@ -224,23 +255,43 @@ class Markdown(object):
         assert isinstance(self.extras, dict)
         if "toc" in self.extras and not "header-ids" in self.extras:
             self.extras["header-ids"] = None   # "toc" implies "header-ids"
+        if "gfm" in self.extras:
+            for extra in self._gfm_extras:
+                if extra not in self.extras:
+                    self.extras[extra] = None
         self._instance_extras = self.extras.copy()
 
         self.link_patterns = link_patterns
         self.use_file_vars = use_file_vars
+        # A function returning the url to use for the url of a link or
+        # image, e.g. to make relative urls absolute.
+        self.url_resolver = url_resolver
         self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
 
         self._escape_table = g_escape_table.copy()
         if "smarty-pants" in self.extras:
-            self._escape_table['"'] = _hash_text('"')
-            self._escape_table["'"] = _hash_text("'")
+            for ch in '"\'':
+                self._escape_table[ch] = \
+                    _hash_key_fmt % g_escaped_chars.index(ch)
+        self._backslash_escape_re = re.compile(
+            r"\\([%s])" % re.escape(''.join(self._escape_table)))
+
+        self.span_tokenizer = span_tokenizer
+        if span_tokenizer:
+            self._compile_span_tokenizer()
+
+        self.profile = profile
+        if profile:
+            self._install_profiler()
 
     def reset(self):
         self.urls = {}
         self.titles = {}
         self.html_blocks = {}
         self.html_spans = {}
+        self._hashes = list(g_escaped_chars)
         self.list_level = 0
+        self._toc = None
         self.extras = self._instance_extras.copy()
         if "footnotes" in self.extras:
             self.footnotes = {}
@@ -249,6 +300,8 @@ class Markdown(object):
             self._count_from_header_id = {} # no `defaultdict` in Python 2.4
         if "metadata" in self.extras:
             self.metadata = {}
+        if self.profile:
+            self._profile = {}
 
     # Per <https://developer.mozilla.org/en-US/docs/HTML/Element/a> "rel"
     # should only be used in <a> tags with an "href" attribute.
@@ -267,6 +320,24 @@ class Markdown(object):
         # articles):
         self.reset()
 
+        text = self._prepare_text(text)
+
+        text = self._run_block_gamut(text)
+
+        if "footnotes" in self.extras:
+            text = self._add_footnotes(text)
+
+        text = self._finish_text(text)
+
+        text += "\n"
+
+        return self._result_from_text(text)
+
+    def _prepare_text(self, text):
+        """Normalize the given text and pull out everything that must be
+        known before the block gamut runs: raw HTML blocks, link and
+        footnote definitions, metadata.
+        """
         if not isinstance(text, unicode):
             #TODO: perhaps shouldn't presume UTF-8 for string input?
             text = unicode(text, 'utf-8')
@@ -322,30 +393,90 @@ class Markdown(object):
             text = self._strip_footnote_definitions(text)
         text = self._strip_link_definitions(text)
 
-        text = self._run_block_gamut(text)
-
-        if "footnotes" in self.extras:
-            text = self._add_footnotes(text)
+        return text
 
+    def _finish_text(self, text):
+        """Run the postprocess hook and swap the hashed and escaped parts
+        of the converted text back in.
+        """
         text = self.postprocess(text)
 
         text = self._unescape_special_chars(text)
 
-        if self.safe_mode:
-            text = self._unhash_html_spans(text)
-
         if "nofollow" in self.extras:
             text = self._a_nofollow.sub(r'<\1 rel="nofollow"\2', text)
 
-        text += "\n"
+        return text
 
+    def _result_from_text(self, text):
         rv = UnicodeWithAttrs(text)
         if "toc" in self.extras:
             rv._toc = self._toc
         if "metadata" in self.extras:
             rv.metadata = self.metadata
+        if self.profile:
+            rv.profile = self._profile
         return rv
 
+    # The pipeline stages timed with the `profile` option. Each takes the
+    # text to process as its first argument and returns the processed text.
+    _profiled_stages = [
+        "_prepare_text", "_hash_html_spans", "_hash_html_blocks",
+        "_strip_footnote_definitions", "_strip_link_definitions",
+        "_run_block_gamut", "_do_fenced_code_blocks", "_do_headers",
+        "_do_lists", "_prepare_pyshell_blocks", "_do_tables", "_do_wiki_tables",
+        "_do_code_blocks", "_do_block_quotes", "_form_paragraphs",
+        "_run_span_gamut", "_tokenize_spans", "_do_code_spans",
+        "_escape_special_chars", "_encode_backslash_escapes", "_do_links",
+        "_do_auto_links", "_do_bare_url_links", "_encode_amps_and_angles",
+        "_do_italics_and_bold", "_do_strike", "_do_smart_punctuation", "_do_link_patterns", "_add_footnotes",
+        "_finish_text", "_unescape_special_chars",
+    ]
+    # Stages that recurse: their stats are also broken down by depth.
+    _profiled_recursive_stages = ["_run_block_gamut", "_run_span_gamut"]
+
+    def _install_profiler(self):
+        """Wrap the pipeline stages of this instance to record, per stage,
+        the number of calls, the wall time (including the stages called
+        from it) and the size of the text in and out.
+
+        The report is the `profile` attribute of the converted text:
+
+            {"_do_lists": {"calls": 2, "time": 0.0012,
+                           "chars_in": 5120, "chars_out": 6034},
+             "_run_block_gamut": {..., "by_depth": {0: {...}, 1: {...}}},
+             ...}
+
+        Nothing is wrapped unless profiling is on, so it costs nothing
+        otherwise.
+        """
+        for name in self._profiled_stages:
+            setattr(self, name, self._profiled_stage(name, getattr(self, name)))
+
+    def _profiled_stage(self, name, method):
+        depth = [0]
+        recursive = name in self._profiled_recursive_stages
+        def profiled_stage(text, *args, **kwargs):
+            level = depth[0]
+            depth[0] += 1
+            start = time.time()
+            try:
+                result = method(text, *args, **kwargs)
+            finally:
+                depth[0] = level
+            elapsed = time.time() - start
+            stats = self._profile.get(name)
+            if stats is None:
+                stats = self._profile[name] = _new_profile_stats()
+            _add_profile_stats(stats, elapsed, len(text), len(result))
+            if recursive:
+                by_depth = stats.setdefault("by_depth", {})
+                if level not in by_depth:
+                    by_depth[level] = _new_profile_stats()
+                _add_profile_stats(by_depth[level], elapsed, len(text), len(result))
+            return result
+        return profiled_stage
+
     def postprocess(self, text):
         """A hook for subclasses to do some postprocessing of the html, if
         desired. This is called before unescaping of special chars and
@@ -577,14 +708,14 @@ class Markdown(object):
                 middle = '\n'.join(lines[1:-1])
                 last_line = lines[-1]
                 first_line = first_line[:m.start()] + first_line[m.end():]
-                f_key = _hash_text(first_line)
+                f_key = self._hash_text(first_line)
                 self.html_blocks[f_key] = first_line
-                l_key = _hash_text(last_line)
+                l_key = self._hash_text(last_line)
                 self.html_blocks[l_key] = last_line
                 return ''.join(["\n\n", f_key,
                     "\n\n", middle, "\n\n",
                     l_key, "\n\n"])
-        key = _hash_text(html)
+        key = self._hash_text(html)
         self.html_blocks[key] = html
         return "\n\n" + key + "\n\n"
 
@@ -630,6 +761,8 @@ class Markdown(object):
 
         # Special case for standalone HTML comments:
         if "<!--" in text:
+            pieces = []
+            end_of_pieces = 0
             start = 0
             while True:
                 # Delimiters for next comment block.
@@ -679,9 +812,14 @@ class Markdown(object):
                 html = text[start_idx:end_idx]
                 if raw and self.safe_mode:
                     html = self._sanitize_html(html)
-                key = _hash_text(html)
+                key = self._hash_text(html)
                 self.html_blocks[key] = html
-                text = text[:start_idx] + "\n\n" + key + "\n\n" + text[end_idx:]
+                pieces.append(text[end_of_pieces:start_idx])
+                pieces.append("\n\n" + key + "\n\n")
+                end_of_pieces = end_idx
+            if pieces:
+                pieces.append(text[end_of_pieces:])
+                text = ''.join(pieces)
 
         if "xml" in self.extras:
             # Treat XML processing instructions and namespaced one-liner
@@ -699,28 +837,9 @@ class Markdown(object):
     def _strip_link_definitions(self, text):
         # Strips link definitions from text, stores the URLs and titles in
         # hash references.
-        less_than_tab = self.tab_width - 1
-
         # Link defs are in the form:
         #   [id]: url "optional title"
-        _link_def_re = re.compile(r"""
-            ^[ ]{0,%d}\[(.+)\]: # id = \1
-              [ \t]*
-              \n?               # maybe *one* newline
-              [ \t]*
-            <?(.+?)>?           # url = \2
-              [ \t]*
-            (?:
-                \n?             # maybe one newline
-                [ \t]*
-                (?<=\s)         # lookbehind for whitespace
-                ['"(]
-                ([^\n]*)        # title = \3
-                ['")]
-                [ \t]*
-            )?  # title is optional
-            (?:\n+|\Z)
-            """ % less_than_tab, re.X | re.M | re.U)
+        _link_def_re = _link_def_re_from_tab_width(self.tab_width)
         return _link_def_re.sub(self._extract_link_def_sub, text)
 
     def _extract_link_def_sub(self, match):
@@ -755,30 +874,13 @@ class Markdown(object):
             [^note-id]:
                 Text of the note.
         """
-        less_than_tab = self.tab_width - 1
-        footnote_def_re = re.compile(r'''
-            ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
-            [ \t]*
-            (                       # footnote text = \2
-              # First line need not start with the spaces.
-              (?:\s*.*\n+)
-              (?:
-                (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
-                .*\n+
-              )*
-            )
-            # Lookahead for non-space at line-start, or end of doc.
-            (?:(?=^[ ]{0,%d}\S)|\Z)
-            ''' % (less_than_tab, self.tab_width, self.tab_width),
-            re.X | re.M)
+        footnote_def_re = _footnote_def_re_from_tab_width(self.tab_width)
         return footnote_def_re.sub(self._extract_footnote_def_sub, text)
 
 
-    _hr_data = [
-        ('*', re.compile(r"^[ ]{0,3}\*(.*?)$", re.M)),
-        ('-', re.compile(r"^[ ]{0,3}\-(.*?)$", re.M)),
-        ('_', re.compile(r"^[ ]{0,3}\_(.*?)$", re.M)),
-    ]
+    # A line of one hr char repeated, with at most two spaces between them,
+    # indented by up to three spaces and followed by any trailing whitespace.
+    _hr_re = re.compile(r"^[ ]{0,3}([*_-])(?:[ ]{0,2}\1)*[^\S\n]*$", re.M | re.U)
 
     def _run_block_gamut(self, text):
         # These are all the transformations that form block-level
@@ -795,18 +897,14 @@ class Markdown(object):
         # Markdown.pl 1.0.1's hr regexes limit the number of spaces between the
         # hr chars to one or two. We'll reproduce that limit here.
         hr = "\n<hr"+self.empty_element_suffix+"\n"
-        for ch, regex in self._hr_data:
-            if ch in text:
-                for m in reversed(list(regex.finditer(text))):
-                    tail = m.group(1).rstrip()
-                    if not tail.strip(ch + ' ') and tail.count("   ") == 0:
-                        start, end = m.span()
-                        text = text[:start] + hr + text[end:]
+        text = self._hr_re.sub(hr, text)
 
         text = self._do_lists(text)
 
         if "pyshell" in self.extras:
             text = self._prepare_pyshell_blocks(text)
+        if "tables" in self.extras:
+            text = self._do_tables(text)
         if "wiki-tables" in self.extras:
             text = self._do_wiki_tables(text)
 
@@ -840,15 +938,61 @@ class Markdown(object):
         if ">>>" not in text:
             return text
 
-        less_than_tab = self.tab_width - 1
-        _pyshell_block_re = re.compile(r"""
-            ^([ ]{0,%d})>>>[ ].*\n   # first line
-            ^(\1.*\S+.*\n)*         # any number of subsequent lines
-            ^\n                     # ends with a blank line
-            """ % less_than_tab, re.M | re.X)
-
+        _pyshell_block_re = _pyshell_block_re_from_tab_width(self.tab_width)
         return _pyshell_block_re.sub(self._pyshell_block_sub, text)
 
+    def _table_row_cells(self, row):
+        # Split a table row on the '|' not escaped with a backslash,
+        # leading and trailing ones being optional.
+        row = row.strip()
+        if row.startswith('|'):
+            row = row[1:]
+        if row.endswith('|') and not row.endswith('\\|'):
+            row = row[:-1]
+        return [cell.strip().replace('\\|', '|')
+                for cell in re.split(r'(?<!\\)\|', row)]
+
+    def _table_sub(self, match):
+        head, underline, body = match.groups()
+        aligns = []
+        for cell in self._table_row_cells(underline):
+            if cell.startswith(':') and cell.endswith(':'):
+                aligns.append(' align="center"')
+            elif cell.startswith(':'):
+                aligns.append(' align="left"')
+            elif cell.endswith(':'):
+                aligns.append(' align="right"')
+            else:
+                aligns.append('')
+
+        hlines = ['<table%s>' % self._html_class_str_from_tag('table'),
+                  '<thead>', '<tr>']
+        for align, cell in zip(aligns, self._table_row_cells(head)):
+            hlines.append('<th%s>%s</th>' % (align, self._run_span_gamut(cell)))
+        hlines += ['</tr>', '</thead>']
+        if body:
+            hlines.append('<tbody>')
+            for line in body.strip('\n').split('\n'):
+                cells = self._table_row_cells(line)
+                # Rows have as many cells as the header row.
+                cells = (cells + [''] * len(aligns))[:len(aligns)]
+                hlines.append('<tr>')
+                for align, cell in zip(aligns, cells):
+                    hlines.append('<td%s>%s</td>' % (align, self._run_span_gamut(cell)))
+                hlines.append('</tr>')
+            hlines.append('</tbody>')
+        hlines.append('</table>')
+        return '\n'.join(hlines) + '\n'
+
+    def _do_tables(self, text):
+        """Process GitHub-flavored Markdown tables ('tables' extra)."""
+        # Optimization.
+        if "|" not in text:
+            return text
+
+        table_re = _table_re_from_tab_width(self.tab_width)
+        return table_re.sub(self._table_sub, text)
+
     def _wiki_table_sub(self, match):
         ttext = match.group(0).strip()
         #print 'wiki table: %r' % match.group(0)
@@ -875,18 +1019,17 @@ class Markdown(object):
         if "||" not in text:
             return text
 
-        less_than_tab = self.tab_width - 1
-        wiki_table_re = re.compile(r'''
-            (?:(?<=\n\n)|\A\n?)            # leading blank line
-            ^([ ]{0,%d})\|\|.+?\|\|[ ]*\n  # first line
-            (^\1\|\|.+?\|\|\n)*        # any number of subsequent lines
-            ''' % less_than_tab, re.M | re.X)
+        wiki_table_re = _wiki_table_re_from_tab_width(self.tab_width)
         return wiki_table_re.sub(self._wiki_table_sub, text)
 
     def _run_span_gamut(self, text):
         # These are all the transformations that occur *within* block-level
         # tags like paragraphs, headers, and list items.
 
+        if self.span_tokenizer and "link-patterns" not in self.extras \
+                and "autolink-urls" not in self.extras:
+            return self._tokenize_spans(text)
+
         text = self._do_code_spans(text)
 
         text = self._escape_special_chars(text)
@@ -899,6 +1042,9 @@ class Markdown(object):
         # delimiters in inline links like [this](<url>).
         text = self._do_auto_links(text)
 
+        if "autolink-urls" in self.extras:
+            text = self._do_bare_url_links(text)
+
         if "link-patterns" in self.extras:
             text = self._do_link_patterns(text)
 
@@ -906,6 +1052,9 @@ class Markdown(object):
 
         text = self._do_italics_and_bold(text)
 
+        if "strike" in self.extras:
+            text = self._do_strike(text)
+
         if "smarty-pants" in self.extras:
             text = self._do_smart_punctuation(text)
 
@@ -914,6 +1063,305 @@ class Markdown(object):
 
         return text
 
+    def _compile_span_tokenizer(self):
+        # The backslash escapes depend on the extras (smarty-pants adds
+        # quotes), so these are built per instance.
+        escapable = re.escape(''.join(self._escape_table))
+        self._span_token_re = re.compile(
+            r"\\[%s]|`|!?\[|[<&>]|[ ]{2,}\n" % escapable)
+        self._span_bracket_re = re.compile(r"\\[%s]|`|[\[\]]" % escapable)
+        # `_tail_of_inline_link_re` and `_tail_of_reference_link_re` as
+        # they would match after `_escape_special_chars()`, i.e. with an
+        # escaped character never ending the url, title or id.
+        unit = r"(?:\\[%s]|(?!\\[%s]).)" % (escapable, escapable)
+        self._span_inline_tail_re = re.compile(r"""
+            \(
+              [ \t]*
+              (?P<url>
+                  <.*?>
+                  |
+                  %s*?
+              )
+              [ \t]*
+              (
+                (['"])
+                (?P<title>%s*?)
+                \3
+              )?
+            \)
+            """ % (unit, unit), re.X | re.S)
+        self._span_reference_tail_re = re.compile(r"""
+            [ ]?
+            (?:\n[ ]*)?
+            \[
+              (?P<id>%s*?)
+            \]
+            """ % unit, re.X | re.S)
+
+    def _tokenize_spans(self, text):
+        """A single-pass alternative to the span gamut, used with the
+        `span_tokenizer` option.
+
+        Code spans, backslash escapes, HTML tags, links, images, footnote
+        refs, auto-links, the encoding of ampersands and angle brackets,
+        and hard breaks are all handled in one left-to-right scan of the
+        text that collects its output in a list. Only emphasis and
+        smarty-pants are left as passes over the joined result, so they
+        see the same text as in `_run_span_gamut()`.
+
+        The output is that of `_run_span_gamut()`, except that:
+        - backticks, brackets and auto-links inside HTML tags or link urls
+          and titles are left alone rather than processed as Markdown;
+        - a '<' not closed before a code span is not taken as the start of
+          a tag ending at the '>' of the `<code>` tag;
+        - backslash escapes are resolved left to right, and only for the
+          Markdown special characters;
+        - with the "link-patterns" or "autolink-urls" extra the regular span
+          gamut is used.
+        """
+        out = []
+        self._scan_spans(text, 0, len(text), out)
+        if self._naked_lt_marker in out:
+            # Whether a '<' is encoded depends on what follows it in the
+            # output.
+            following = ''
+            for i in range(len(out) - 1, -1, -1):
+                if out[i] == self._naked_lt_marker:
+                    out[i] = self._naked_lt_re.match('<' + following) \
+                             and '&lt;' or '<'
+                following = out[i] or following
+        text = ''.join(out)
+        if '*' in text or '_' in text:
+            text = self._do_italics_and_bold(text)
+        if "strike" in self.extras:
+            text = self._do_strike(text)
+        if "smarty-pants" in self.extras:
+            text = self._do_smart_punctuation(text)
+        return text
+
+    def _scan_spans(self, text, pos, end, out, links=True, anchors=True,
+                    encode=True):
+        """Scan `text[pos:end]` for span-level syntax, appending the
+        output to `out`.
+
+        With `encode` false, only code spans, backslash escapes and HTML
+        tags are processed -- the text as `_do_links()` would see it, as
+        needed for img alt text and for link urls, titles and ids.
+        """
+        token_re = self._span_token_re
+        while True:
+            match = token_re.search(text, pos, end)
+            if match is None:
+                break
+            start = match.start()
+            if start > pos:
+                out.append(text[pos:start])
+            pos = match.end()
+            token = match.group()
+            ch = token[0]
+            if ch == '\\':
+                out.append(self._escape_table[token[1]])
+            elif ch == '`':
+                code_match = self._code_span_re.match(text, start, end)
+                if code_match:
+                    out.append(self._code_span_sub(code_match))
+                    pos = code_match.end()
+                else:
+                    out.append(ch)
+            elif ch == '<':
+                pos = self._scan_angle_bracket(text, start, end, out, encode)
+            elif ch == '[' or ch == '!':
+                if links:
+                    pos = self._scan_link(text, start, end, out, anchors)
+                else:
+                    out.append(token)
+            elif not encode:
+                out.append(token)
+            elif ch == '&':
+                if self._ampersand_re.match(text, start, end):
+                    out.append('&amp;')
+                else:
+                    out.append(ch)
+            elif ch == '>':
+                prev = out and out[-1][-1:] or ''
+                if self._naked_gt_re.search(prev + ch):
+                    out.append('&gt;')
+                else:
+                    out.append(ch)
+            else:
+                out.append(" <br%s\n" % self.empty_element_suffix)
+        out.append(text[pos:end])
+
+    def _scan_escaped(self, text, start, end):
+        out = []
+        self._scan_spans(text, start, end, out, links=False, encode=False)
+        return ''.join(out)
+
+    def _encode_span_markup(self, markup):
+        # Run the auto-link, amp/angle and hard break transformations of
+        # `_run_span_gamut()` over a tag from `_scan_spans()`.
+        if ':' in markup or '@' in markup:
+            markup = self._do_auto_links(markup)
+        markup = self._encode_amps_and_angles(markup)
+        if "  \n" in markup:
+            markup = re.sub(r" {2,}\n", " <br%s\n" % self.empty_element_suffix,
+                            markup)
+        return markup
+
+    _naked_lt_marker = '\x00<'
+    def _scan_angle_bracket(self, text, start, end, out, encode):
+        match = self._sorta_html_tokenize_re.match(text, start, end)
+        if match:
+            markup = (match.group().replace('*', self._escape_table['*'])
+                                   .replace('_', self._escape_table['_']))
+            if encode:
+                markup = self._encode_span_markup(markup)
+            out.append(markup)
+            return match.end()
+        if encode:
+            match = self._auto_email_link_re.match(text, start, end)
+            if match:
+                out.append(self._auto_email_link_sub(match))
+                return match.end()
+            out.append(self._naked_lt_marker)
+            return start + 1
+        out.append('<')
+        return start + 1
+
+    def _scan_link(self, text, start, end, out, anchors):
+        """Handle the link, image or footnote ref starting with the '[' or
+        '![' at `start` as `_do_links()` would, returning the position to
+        continue scanning from.
+        """
+        MAX_LINK_TEXT_SENTINEL = 3000  # markdown2 issue 24
+
+        is_img = text[start] == '!'
+        open_idx = is_img and start + 1 or start
+        not_markup = text[start:open_idx+1]
+
+        # Find the matching closing ']', skipping escaped brackets and
+        # those in code spans.
+        bracket_depth = 0
+        limit = min(open_idx + MAX_LINK_TEXT_SENTINEL, end)
+        pos = open_idx + 1
+        while True:
+            match = self._span_bracket_re.search(text, pos, limit)
+            if match is None:
+                # Closing bracket not found within sentinel length.
+                # This isn't markup.
+                out.append(not_markup)
+                return open_idx + 1
+            pos = match.end()
+            ch = match.group()[0]
+            if ch == '`':
+                code_match = self._code_span_re.match(text, match.start(), end)
+                if code_match:
+                    pos = code_match.end()
+            elif ch == '[':
+                bracket_depth += 1
+            elif ch == ']':
+                bracket_depth -= 1
+                if bracket_depth < 0:
+                    break
+        close_idx = match.start()
+        link_text = self._scan_escaped(text, open_idx + 1, close_idx)
+
+        # Possibly a footnote ref?
+        if "footnotes" in self.extras and link_text.startswith("^"):
+            if is_img:
+                out.append('!')
+            normed_id = re.sub(r'\W', '-', link_text[1:])
+            if normed_id in self.footnotes:
+                self.footnote_ids.append(normed_id)
+                out.append('<sup class="footnote-ref" id="fnref-%s">'
+                           '<a href="#fn-%s">%s</a></sup>'
+                           % (normed_id, normed_id, len(self.footnote_ids)))
+            else:
+                # This id isn't defined, leave the markup alone.
+                self._scan_spans(text, open_idx, close_idx + 1, out,
+                                 links=False)
+            return close_idx + 1
+
+        # Now determine what this is by the remainder.
+        pos = close_idx + 1
+        if pos == len(text):
+            self._scan_spans(text, start, end, out, links=False)
+            return end
+
+        if text[pos] == '(':
+            match = self._span_inline_tail_re.match(text, pos, end)
+            if match is None:
+                out.append(not_markup)
+                return open_idx + 1
+            url = self._scan_escaped(text, *match.span("url"))
+            if url and url[0] == '<':
+                url = url[1:-1]  # '<url>' -> 'url'
+            if self.url_resolver:
+                url = self.url_resolver(url)
+            url = url.replace('*', self._escape_table['*']) \
+                     .replace('_', self._escape_table['_'])
+            if match.group("title"):
+                title = self._scan_escaped(text, *match.span("title"))
+                title_str = ' title="%s"' % (
+                    _xml_escape_attr(title)
+                        .replace('*', self._escape_table['*'])
+                        .replace('_', self._escape_table['_']))
+            else:
+                title_str = ''
+            alt = is_img and _xml_escape_attr(link_text)
+        else:
+            match = self._span_reference_tail_re.match(text, pos, end)
+            if match is None:
+                out.append(not_markup)
+                return open_idx + 1
+            link_id = self._scan_escaped(text, *match.span("id")).lower()
+            if not link_id:
+                link_id = link_text.lower()  # for links like [this][]
+            if link_id not in self.urls:
+                # This id isn't defined, leave the markup alone.
+                self._scan_spans(text, start, match.end(), out, links=False)
+                return match.end()
+            url = self.urls[link_id]
+            if self.url_resolver:
+                url = self.url_resolver(url)
+            url = url.replace('*', self._escape_table['*']) \
+                     .replace('_', self._escape_table['_'])
+            title = self.titles.get(link_id)
+            if title:
+                title_str = ' title="%s"' % (
+                    _xml_escape_attr(title)
+                        .replace('*', self._escape_table['*'])
+                        .replace('_', self._escape_table['_']))
+            else:
+                title_str = ''
+            alt = is_img and link_text.replace('"', '&quot;')
+
+        if is_img:
+            result = '<img src="%s" alt="%s"%s%s' \
+                % (url.replace('"', '&quot;'), alt, title_str,
+                   self.empty_element_suffix)
+            if "smarty-pants" in self.extras:
+                result = result.replace('"', self._escape_table['"'])
+            out.append(self._encode_span_markup(result))
+        elif anchors:
+            result_head = '<a href="%s"%s>' % (url, title_str)
+            if "smarty-pants" in self.extras:
+                result_head = result_head.replace('"', self._escape_table['"'])
+            out.append(self._encode_span_markup(result_head))
+            first = len(out)
+            # <img> allowed in the link text, <a> not.
+            self._scan_spans(text, open_idx + 1, close_idx, out,
+                             anchors=False)
+            if "smarty-pants" in self.extras:
+                out[first:] = [s.replace('"', self._escape_table['"'])
+                               for s in out[first:]]
+            out.append('</a>')
+        else:
+            # Anchor not allowed here.
+            out.append(not_markup)
+            return open_idx + 1
+        return match.end()
+
     # "Sorta" because auto-links are identified as "tag" tokens.
     _sorta_html_tokenize_re = re.compile(r"""
         (
@@ -946,9 +1394,7 @@ class Markdown(object):
                 # Within tags/HTML-comments/auto-links, encode * and _
                 # so they don't conflict with their use in Markdown for
                 # italics and strong.  We're replacing each such
-                # character with its corresponding MD5 checksum value;
-                # this is likely overkill, but it should prevent us from
-                # colliding with the escape values by accident.
+                # character with its hash key (see `_hash_text()`).
                 escaped.append(token.replace('*', self._escape_table['*'])
                                     .replace('_', self._escape_table['_']))
             else:
@@ -971,7 +1417,7 @@ class Markdown(object):
         for token in self._sorta_html_tokenize_re.split(text):
             if is_html_markup and not _is_auto_link(token):
                 sanitized = self._sanitize_html(token)
-                key = _hash_text(sanitized)
+                key = self._hash_text(sanitized)
                 self.html_spans[key] = sanitized
                 tokens.append(key)
             else:
@@ -979,11 +1425,6 @@ class Markdown(object):
             is_html_markup = not is_html_markup
         return ''.join(tokens)
 
-    def _unhash_html_spans(self, text):
-        for key, sanitized in list(self.html_spans.items()):
-            text = text.replace(key, sanitized)
-        return text
-
     def _sanitize_html(self, s):
         if self.safe_mode == "replace":
             return self.html_removed_text
@@ -1118,6 +1559,8 @@ class Markdown(object):
                     url, title = match.group("url"), match.group("title")
                     if url and url[0] == '<':
                         url = url[1:-1]  # '<url>' -> 'url'
+                    if self.url_resolver:
+                        url = self.url_resolver(url)
                     # We've got to encode these to avoid conflicting
                     # with italics/bold.
                     url = url.replace('*', self._escape_table['*']) \
@@ -1166,6 +1609,8 @@ class Markdown(object):
                         link_id = link_text.lower()  # for links like [this][]
                     if link_id in self.urls:
                         url = self.urls[link_id]
+                        if self.url_resolver:
+                            url = self.url_resolver(url)
                         # We've got to encode these to avoid conflicting
                         # with italics/bold.
                         url = url.replace('*', self._escape_table['*']) \
@@ -1323,53 +1768,37 @@ class Markdown(object):
     def _do_lists(self, text):
         # Form HTML ordered (numbered) and unordered (bulleted) lists.
 
-        # Iterate over each *non-overlapping* list match.
+        # Find the *first* hit for either list style (ul or ol). We
+        # match ul and ol separately to avoid adjacent lists of different
+        # types running into each other (see issue #16).
+        list_res = [_list_re_from_tab_width(self.tab_width, marker_pat,
+                                            bool(self.list_level))
+                    for marker_pat in (self._marker_ul, self._marker_ol)]
+        hits = [list_re.search(text) for list_re in list_res]
+
+        # Iterate over each *non-overlapping* list match, collecting the
+        # output pieces so that the text is only assembled once.
+        pieces = []
         pos = 0
         while True:
-            # Find the *first* hit for either list style (ul or ol). We
-            # match ul and ol separately to avoid adjacent lists of different
-            # types running into each other (see issue #16).
-            hits = []
-            for marker_pat in (self._marker_ul, self._marker_ol):
-                less_than_tab = self.tab_width - 1
-                whole_list = r'''
-                    (                   # \1 = whole list
-                      (                 # \2
-                        [ ]{0,%d}
-                        (%s)            # \3 = first list item marker
-                        [ \t]+
-                        (?!\ *\3\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
-                      )
-                      (?:.+?)
-                      (                 # \4
-                          \Z
-                        |
-                          \n{2,}
-                          (?=\S)
-                          (?!           # Negative lookahead for another list item marker
-                            [ \t]*
-                            %s[ \t]+
-                          )
-                      )
-                    )
-                ''' % (less_than_tab, marker_pat, marker_pat)
-                if self.list_level:  # sub-list
-                    list_re = re.compile("^"+whole_list, re.X | re.M | re.S)
-                else:
-                    list_re = re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
-                                         re.X | re.M | re.S)
-                match = list_re.search(text, pos)
-                if match:
-                    hits.append((match.start(), match))
-            if not hits:
+            match = None
+            for i, hit in enumerate(hits):
+                if hit is not None and hit.start() < pos:
+                    # overlaps the last list: look again past it
+                    hits[i] = hit = list_res[i].search(text, pos)
+                if hit is not None and (match is None or hit.start() < match.start()):
+                    match = hit
+            if match is None:
                 break
-            hits.sort()
-            match = hits[0][1]
             start, end = match.span()
-            text = text[:start] + self._list_sub(match) + text[end:]
+            pieces.append(text[pos:start])
+            pieces.append(self._list_sub(match))
             pos = end
 
-        return text
+        if not pieces:
+            return text
+        pieces.append(text[pos:])
+        return ''.join(pieces)
 
     _list_item_re = re.compile(r'''
         (\n)?                   # leading line = \1
@@ -1382,10 +1811,17 @@ class Markdown(object):
         re.M | re.X | re.S)
 
     _last_li_endswith_two_eols = False
+    _task_list_item_re = re.compile(r"\[([ xX])\][ \t]+")
+
     def _list_item_sub(self, match):
         item = match.group(4)
         leading_line = match.group(1)
         leading_space = match.group(2)
+        task = None
+        if "task-lists" in self.extras:
+            task = self._task_list_item_re.match(item)
+            if task:
+                item = item[task.end():]
         if leading_line or "\n\n" in item or self._last_li_endswith_two_eols:
             item = self._run_block_gamut(self._outdent(item))
         else:
@@ -1395,6 +1831,15 @@ class Markdown(object):
                 item = item[:-1]
             item = self._run_span_gamut(item)
         self._last_li_endswith_two_eols = (len(match.group(5)) == 2)
+        if task:
+            checkbox = '<input type="checkbox" class="task-list-item-checkbox" disabled="disabled"%s%s ' % (
+                task.group(1) != ' ' and ' checked="checked"' or '',
+                self.empty_element_suffix)
+            if item.startswith('<p>'):
+                item = '<p>' + checkbox + item[3:]
+            else:
+                item = checkbox + item
+            return '<li class="task-list-item">%s</li>\n' % item
         return "<li>%s</li>\n" % item
 
     def _process_list_items(self, list_str):
@@ -1463,10 +1908,10 @@ class Markdown(object):
     def _code_block_sub(self, match, is_fenced_code_block=False):
         lexer_name = None
         if is_fenced_code_block:
-            lexer_name = match.group(1)
+            lexer_name = match.group('lang')
             if lexer_name:
                 formatter_opts = self.extras['fenced-code-blocks'] or {}
-            codeblock = match.group(2)
+            codeblock = match.group('code')
             codeblock = codeblock[:-1]  # drop one trailing newline
         else:
             codeblock = match.group(1)
@@ -1512,31 +1957,35 @@ class Markdown(object):
 
     def _do_code_blocks(self, text):
         """Process Markdown `<pre><code>` blocks."""
-        code_block_re = re.compile(r'''
-            (?:\n\n|\A\n?)
-            (               # $1 = the code block -- one or more lines, starting with a space/tab
-              (?:
-                (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
-                .*\n+
-              )+
-            )
-            ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
-            ''' % (self.tab_width, self.tab_width),
-            re.M | re.X)
+        code_block_re = _code_block_re_from_tab_width(self.tab_width)
         return code_block_re.sub(self._code_block_sub, text)
 
     _fenced_code_block_re = re.compile(r'''
         (?:\n\n|\A\n?)
-        ^```([\w+-]+)?[ \t]*\n      # opening fence, $1 = optional lang
-        (.*?)                       # $2 = code block content
-        ^```[ \t]*\n                # closing fence
+        ^```(?P<lang>[\w+-]+)?[ \t]*\n   # opening fence, optional lang
+        (?P<code>.*?)                   # code block content
+        ^```[ \t]*\n                    # closing fence
+        ''', re.M | re.X | re.S)
+
+    # With the "gfm" extra, code blocks can also be fenced with '~~~' and,
+    # as on GitHub, need no blank line before them: a fence can interrupt a
+    # paragraph or directly follow another fenced code block.
+    _gfm_fenced_code_block_re = re.compile(r'''
+        (?:\n+|\A)
+        ^(?P<fence>```|~~~)(?P<lang>[\w+-]+)?[ \t]*\n   # opening fence, optional lang
+        (?P<code>.*?)                                   # code block content
+        ^(?P=fence)[ \t]*\n                              # closing fence
         ''', re.M | re.X | re.S)
 
     def _fenced_code_block_sub(self, match):
         return self._code_block_sub(match, is_fenced_code_block=True);
 
     def _do_fenced_code_blocks(self, text):
-        """Process ```-fenced unindented code blocks ('fenced-code-blocks' extra)."""
+        """Process ```-fenced unindented code blocks ('fenced-code-blocks' extra),
+        and ~~~-fenced ones with the 'gfm' extra.
+        """
+        if "gfm" in self.extras:
+            return self._gfm_fenced_code_block_re.sub(self._fenced_code_block_sub, text)
         return self._fenced_code_block_re.sub(self._fenced_code_block_sub, text)
 
     # Rules for a code span:
@@ -1602,9 +2051,14 @@ class Markdown(object):
         ]
         for before, after in replacements:
             text = text.replace(before, after)
-        hashed = _hash_text(text)
-        self._escape_table[text] = hashed
-        return hashed
+        return self._hash_text(text)
+
+    _strike_re = re.compile(r"~~(?=\S)(.+?)(?<=\S)~~", re.S)
+    def _do_strike(self, text):
+        """Process ~~struck through~~ text ('strike' extra)."""
+        if "~~" not in text:
+            return text
+        return self._strike_re.sub(r"<del>\1</del>", text)
 
     _strong_re = re.compile(r"(\*\*|__)(?=\S)(.+?[*_]*)(?<=\S)\1", re.S)
     _em_re = re.compile(r"(\*|_)(?=\S)(.+?)(?<=\S)\1", re.S)
@@ -1785,9 +2239,11 @@ class Markdown(object):
         return text
 
     def _encode_backslash_escapes(self, text):
-        for ch, escape in list(self._escape_table.items()):
-            text = text.replace("\\"+ch, escape)
-        return text
+        if '\\' not in text:
+            return text
+        escape_table = self._escape_table
+        return self._backslash_escape_re.sub(
+            lambda match: escape_table[match.group(1)], text)
 
     _auto_link_re = re.compile(r'<((https?|ftp):[^\'">\s]+)>', re.I)
     def _auto_link_sub(self, match):
@@ -1813,6 +2269,48 @@ class Markdown(object):
         text = self._auto_email_link_re.sub(self._auto_email_link_sub, text)
         return text
 
+    # A link or a tag, left alone, or a bare URL. Trailing punctuation is
+    # trimmed from the URL by `_bare_url_link_sub()`.
+    _bare_url_re = re.compile(r'''
+        (<a\s[^>]*>.*?</a>|<[^>]*>)         # $1 = a link or a tag
+        |
+        (?<![\w/.@-])                      # not within a word or path
+        ((?:https?://|www\.)[^\s<>"]+)     # $2 = the url
+        ''', re.I | re.S | re.X)
+    _bare_url_trailing_chars = "?!.,:;*_~'"
+    def _bare_url_link_sub(self, match):
+        url = match.group(2)
+        if not url:
+            return match.group(1)
+        end = len(url)
+        while end:
+            ch = url[end-1]
+            if ch in self._bare_url_trailing_chars:
+                end -= 1
+            elif ch == ')' and url.count('(', 0, end) < url.count(')', 0, end):
+                end -= 1
+            else:
+                break
+        url, trailing = url[:end], url[end:]
+        if url.lower().startswith('www.'):
+            if len(url) == 4:
+                return match.group(0)
+            href = 'http://' + url
+        else:
+            href = url
+        href = self._ampersand_re.sub('&amp;', href).replace('"', '&quot;')
+        link = '<a href="%s">%s</a>' % (href, self._ampersand_re.sub('&amp;', url))
+        # Hashed so that the '_' and '*' in the url aren't taken as emphasis.
+        return self._hash_text(link) + trailing
+
+    def _do_bare_url_links(self, text):
+        """Link the bare URLs that aren't in a link or tag already
+        ('autolink-urls' extra).
+        """
+        if "://" not in text and "www." not in text.lower():
+            return text
+        return self._bare_url_re.sub(self._bare_url_link_sub, text)
+
     def _encode_email_address(self, addr):
         #  Input: an email address, e.g. "foo@example.com"
         #
@@ -1841,7 +2339,7 @@ class Markdown(object):
         Dev Notes: *Could* consider prefixing regexes with a negative
         lookbehind assertion to attempt to guard against this.
         """
-        link_from_hash = {}
+        first_link = len(self._hashes)
         for regex, repl in self.link_patterns:
             replacements = []
             for match in regex.finditer(text):
@@ -1857,18 +2355,38 @@ class Markdown(object):
                         .replace('*', self._escape_table['*'])
                         .replace('_', self._escape_table['_']))
                 link = '<a href="%s">%s</a>' % (escaped_href, text[start:end])
-                hash = _hash_text(link)
-                link_from_hash[hash] = link
-                text = text[:start] + hash + text[end:]
-        for hash, link in list(link_from_hash.items()):
-            text = text.replace(hash, link)
-        return text
+                text = text[:start] + self._hash_text(link) + text[end:]
+
+        # Swap back in only the links.
+        hashes = self._hashes
+        def _unhash_link_sub(match):
+            i = int(match.group(1))
+            if i < first_link:
+                return match.group(0)
+            return hashes[i]
+        return _hash_key_re.sub(_unhash_link_sub, text)
+
+    def _hash_text(self, s):
+        """Return the key that `s` is to be replaced with until swapped
+        back in by `_unescape_special_chars()`.
+        """
+        key = _hash_key_fmt % len(self._hashes)
+        self._hashes.append(s)
+        return key
 
     def _unescape_special_chars(self, text):
-        # Swap back in all the special characters we've hidden.
-        for ch, hash in list(self._escape_table.items()):
-            text = text.replace(hash, ch)
-        return text
+        # Swap back in all the special characters, code spans and HTML
+        # we've hidden, in a single pass per level of nesting (e.g. code
+        # spans in links made by `_do_link_patterns()`).
+        if SECRET_SALT not in text:
+            return text
+        hashes = self._hashes
+        def _unhash_sub(match):
+            return hashes[int(match.group(1))]
+        while True:
+            text, n = _hash_key_re.subn(_unhash_sub, text)
+            if not n:
+                return text
 
     def _outdent(self, text):
         # Remove one level of line-leading tabs or spaces
@@ -1890,6 +2408,168 @@ class MarkdownWithExtras(Markdown):
     extras = ["footnotes", "code-color"]
 
 
+class IncrementalMarkdown(Markdown):
+    """A markdowner class for converting successive versions of the same
+    document, e.g. an editor buffer on every save.
+
+    The document is split into top-level blocks and the HTML of each block
+    is kept from one `convert()` to the next, so only the blocks whose
+    source changed are rendered again. Link and footnote definitions are
+    still collected from the whole document.
+
+    The result is the same as that of `Markdown.convert()`, except that
+    footnote numbers, header ids and TOC entries are always assigned in
+    document order. (`Markdown.convert()` assigns them in processing
+    order, e.g. setext headers before atx headers and paragraphs after
+    lists.)
+    """
+    # A chunk following a blank line that matches this continues the
+    # current top-level block: indented text (code blocks, list item
+    # paragraphs), blockquotes and further list items.
+    _block_continuation_re = re.compile(r"[ \t>]|[ ]{0,3}(?:%s)[ \t]"
+                                        % Markdown._marker_any)
+
+    def __init__(self, *args, **kwargs):
+        Markdown.__init__(self, *args, **kwargs)
+        self._block_cache = {}
+        self._block_cache_extras = None
+        self._block_cache_url_resolver = None
+
+    def reset(self):
+        Markdown.reset(self)
+        self._header_log = None
+
+    def convert(self, text):
+        """Convert the given text, re-using the HTML of the blocks that
+        are unchanged since the previous call.
+        """
+        self.reset()
+
+        text = self._prepare_text(text)
+
+        # The output of a block also depends on the link and footnote
+        # definitions made anywhere in the document, on the extras and on
+        # the url resolver.
+        defs = repr((sorted(self.urls.items()), sorted(self.titles.items()),
+                     "footnotes" in self.extras and sorted(self.footnotes)))
+        if self.extras != self._block_cache_extras \
+                or self.url_resolver is not self._block_cache_url_resolver:
+            self._block_cache = {}
+            self._block_cache_extras = self.extras.copy()
+            self._block_cache_url_resolver = self.url_resolver
+        prev_cache, self._block_cache = self._block_cache, {}
+
+        html = []
+        for block in self._split_blocks(text):
+            # The keys of hashed HTML depend on what comes before them in
+            # the document, so the cache is keyed on what they stand for.
+            source = self._unescape_special_chars(block)
+            if "footnotes" in self.extras:
+                key = (source, defs, len(self.footnote_ids))
+            else:
+                key = (source, defs)
+            entry = self._block_cache.get(key) or prev_cache.get(key)
+            if entry is None or not self._replay_block(entry):
+                entry = self._render_block(block)
+            self._block_cache[key] = entry
+            html.append(entry[0])
+        text = "\n\n".join(html)
+
+        if "footnotes" in self.extras:
+            text += self._finish_text(self._add_footnotes(""))
+
+        text += "\n"
+
+        return self._result_from_text(text)
+
+    def _split_blocks(self, text):
+        """Split the prepared text into top-level blocks that can be
+        converted independently of each other.
+        """
+        text = text.strip("\n")
+
+        # The (start of the opening fence line, end of the closing fence
+        # line) of the fenced code blocks, found with the regex that
+        # `_do_fenced_code_blocks()` uses so that they are never split.
+        fences = []
+        if "fenced-code-blocks" in self.extras:
+            if "gfm" in self.extras:
+                fenced_code_block_re = self._gfm_fenced_code_block_re
+            else:
+                fenced_code_block_re = self._fenced_code_block_re
+            for match in fenced_code_block_re.finditer(text + "\n\n"):
+                start = match.start() + len(match.group()) \
+                        - len(match.group().lstrip("\n"))
+                fences.append((start, match.end() - 1))
+        fence_starts = set([start for start, end in fences])
+
+        blocks = []
+        start = 0
+        i = 0
+        for match in re.finditer(r"\n{2,}", text):
+            gap_start, gap_end = match.span()
+            while i < len(fences) and fences[i][1] <= gap_start:
+                i += 1
+            if i < len(fences) and fences[i][0] < gap_end:
+                # Inside a fenced code block.
+                continue
+            if text.startswith(("```", "~~~"), gap_end) \
+                    and gap_end not in fence_starts:
+                # A fence the fenced code block regex doesn't see here
+                # (e.g. right after another fenced code block) would be
+                # seen at the start of a block.
+                continue
+            if self._block_continuation_re.match(text, gap_end):
+                continue
+            blocks.append(text[start:gap_start])
+            start = gap_end
+        blocks.append(text[start:])
+        return blocks
+
+    def _render_block(self, block):
+        toc_start = self._toc and len(self._toc) or 0
+        if "footnotes" in self.extras:
+            footnotes_start = len(self.footnote_ids)
+        self._header_log = []
+
+        html = self._run_block_gamut(block + "\n\n")
+        html = self._finish_text(html)
+
+        header_log, self._header_log = self._header_log, None
+        toc = self._toc and self._toc[toc_start:] or []
+        if "footnotes" in self.extras:
+            footnote_ids = self.footnote_ids[footnotes_start:]
+        else:
+            footnote_ids = []
+        return (html, header_log, toc, footnote_ids)
+
+    def _replay_block(self, entry):
+        """Apply the side effects of rendering a cached block to the
+        conversion state. Return False if the block has to be rendered
+        again, i.e. if its header ids would now come out differently.
+        """
+        html, header_log, toc, footnote_ids = entry
+        if header_log:
+            counts = self._count_from_header_id.copy()
+            for text, prefix, n, header_id in header_log:
+                if self.header_id_from_text(text, prefix, n) != header_id:
+                    self._count_from_header_id = counts
+                    return False
+        if toc:
+            if self._toc is None:
+                self._toc = []
+            self._toc.extend(toc)
+        if footnote_ids:
+            self.footnote_ids.extend(footnote_ids)
+        return True
+
+    def header_id_from_text(self, text, prefix, n):
+        header_id = Markdown.header_id_from_text(self, text, prefix, n)
+        if self._header_log is not None:
+            self._header_log.append((text, prefix, n, header_id))
+        return header_id
+
+
 #---- internal support functions
 
 class UnicodeWithAttrs(unicode):
@@ -1898,6 +2578,7 @@ class UnicodeWithAttrs(unicode):
     the "toc" extra is used.
     """
     metadata = None
+    profile = None
     _toc = None
     def toc_html(self):
         """Return the HTML for the current TOC.
@@ -2080,6 +2761,30 @@ def _dedent(text, tabsize=8, skip_first_line=False):
     return ''.join(lines)
 
 
+def _new_profile_stats():
+    return {"calls": 0, "time": 0.0, "chars_in": 0, "chars_out": 0}
+
+def _add_profile_stats(stats, elapsed, chars_in, chars_out):
+    stats["calls"] += 1
+    stats["time"] += elapsed
+    stats["chars_in"] += chars_in
+    stats["chars_out"] += chars_out
+
+def _format_profile(profile):
+    """Format a `profile` report (see `Markdown._install_profiler()`) as a
+    table, slowest stage first.
+    """
+    lines = ["%-30s %6s %10s %10s %10s" % ("stage", "calls", "ms", "chars in", "chars out")]
+    def add(label, stats):
+        lines.append("%-30s %6d %10.2f %10d %10d" % (label, stats["calls"],
+            stats["time"] * 1000, stats["chars_in"], stats["chars_out"]))
+    for name, stats in sorted(profile.items(), key=lambda item: -item[1]["time"]):
+        add(name, stats)
+        for level, level_stats in sorted(stats.get("by_depth", {}).items()):
+            add("  depth %d" % level, level_stats)
+    return "\n".join(lines) + "\n"
+
+
 class _memoized(object):
    """Decorator that caches a function's return value each time it is called.
    If called later with the same arguments, the cached value is returned, and
@@ -2145,6 +2850,125 @@ def _hr_tag_re_from_tab_width(tab_width):
         """ % (tab_width - 1), re.X)
 _hr_tag_re_from_tab_width = _memoized(_hr_tag_re_from_tab_width)
 
+def _link_def_re_from_tab_width(tab_width):
+    """Link definition regex."""
+    return re.compile(r"""
+        ^[ ]{0,%d}\[(.+)\]: # id = \1
+          [ \t]*
+          \n?               # maybe *one* newline
+          [ \t]*
+        <?(.+?)>?           # url = \2
+          [ \t]*
+        (?:
+            \n?             # maybe one newline
+            [ \t]*
+            (?<=\s)         # lookbehind for whitespace
+            ['"(]
+            ([^\n]*)        # title = \3
+            ['")]
+            [ \t]*
+        )?  # title is optional
+        (?:\n+|\Z)
+        """ % (tab_width - 1), re.X | re.M | re.U)
+_link_def_re_from_tab_width = _memoized(_link_def_re_from_tab_width)
+
+def _footnote_def_re_from_tab_width(tab_width):
+    """Footnote definition regex."""
+    return re.compile(r'''
+        ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
+        [ \t]*
+        (                       # footnote text = \2
+          # First line need not start with the spaces.
+          (?:\s*.*\n+)
+          (?:
+            (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
+            .*\n+
+          )*
+        )
+        # Lookahead for non-space at line-start, or end of doc.
+        (?:(?=^[ ]{0,%d}\S)|\Z)
+        ''' % (tab_width - 1, tab_width, tab_width),
+        re.X | re.M)
+_footnote_def_re_from_tab_width = _memoized(_footnote_def_re_from_tab_width)
+
+def _pyshell_block_re_from_tab_width(tab_width):
+    """Python interactive shell session regex."""
+    return re.compile(r"""
+        ^([ ]{0,%d})>>>[ ].*\n   # first line
+        ^(\1.*\S+.*\n)*         # any number of subsequent lines
+        ^\n                     # ends with a blank line
+        """ % (tab_width - 1), re.M | re.X)
+_pyshell_block_re_from_tab_width = _memoized(_pyshell_block_re_from_tab_width)
+
+def _wiki_table_re_from_tab_width(tab_width):
+    """Wiki table regex."""
+    return re.compile(r'''
+        (?:(?<=\n\n)|\A\n?)            # leading blank line
+        ^([ ]{0,%d})\|\|.+?\|\|[ ]*\n  # first line
+        (^\1\|\|.+?\|\|\n)*        # any number of subsequent lines
+        ''' % (tab_width - 1), re.M | re.X)
+_wiki_table_re_from_tab_width = _memoized(_wiki_table_re_from_tab_width)
+
+def _table_re_from_tab_width(tab_width):
+    """GitHub-flavored Markdown table regex."""
+    return re.compile(r'''
+        (?:(?<=\n\n)|\A\n?)            # leading blank line
+        ^[ ]{0,%d}(.*\|.*)\n           # $1 = header row, with at least one '|'
+        ^[ ]{0,%d}(                     # $2 = underline row, with at least one '|'
+            \|?(?:[ \t]*:?-+:?[ \t]*\|)+(?:[ \t]*:?-+:?[ \t]*)?
+        )[ \t]*\n
+        (                               # $3 = body rows
+            (?:^[ ]{0,%d}\S.*\|.*\n)*
+        )
+        ''' % (tab_width - 1, tab_width - 1, tab_width - 1), re.M | re.X)
+_table_re_from_tab_width = _memoized(_table_re_from_tab_width)
+
+def _code_block_re_from_tab_width(tab_width):
+    """Indented code block regex."""
+    return re.compile(r'''
+        (?:\n\n|\A\n?)
+        (               # $1 = the code block -- one or more lines, starting with a space/tab
+          (?:
+            (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
+            .*\n+
+          )+
+        )
+        ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
+        ''' % (tab_width, tab_width),
+        re.M | re.X)
+_code_block_re_from_tab_width = _memoized(_code_block_re_from_tab_width)
+
+def _list_re_from_tab_width(tab_width, marker_pat, sub_list):
+    """Whole list regex for the given marker pattern, anchored for a
+    top-level list or a sub-list."""
+    whole_list = r'''
+        (                   # \1 = whole list
+          (                 # \2
+            [ ]{0,%d}
+            (%s)            # \3 = first list item marker
+            [ \t]+
+            (?!\ *\3\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
+          )
+          (?:.+?)
+          (                 # \4
+              \Z
+            |
+              \n{2,}
+              (?=\S)
+              (?!           # Negative lookahead for another list item marker
+                [ \t]*
+                %s[ \t]+
+              )
+          )
+        )
+    ''' % (tab_width - 1, marker_pat, marker_pat)
+    if sub_list:  # sub-list
+        return re.compile("^"+whole_list, re.X | re.M | re.S)
+    else:
+        return re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
+                          re.X | re.M | re.S)
+_list_re_from_tab_width = _memoized(_list_re_from_tab_width)
+
 
 def _xml_escape_attr(attr, skip_single_quote=True):
     """Escape the given string for use in an HTML/XML tag attribute.
@@ -2188,13 +3012,172 @@ def _test():
     import doctest
     doctest.testmod()
 
+# The files converted when a directory is given with -o|--output-dir.
+_markdown_file_exts = (".md", ".markdown", ".mdown", ".mkd")
+
+# Where the output-dir mode records what it converted, to skip unchanged
+# files on the next run.
+_manifest_name = ".markdown2-manifest.json"
+
+def _markdown_file_paths(paths):
+    """Generate (path, relpath) for the markdown files in the given file and
+    directory paths, relpath being their path in the output directory.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.endswith(_markdown_file_exts):
+                        file_path = os.path.join(dirpath, filename)
+                        yield file_path, os.path.relpath(file_path, path)
+        else:
+            yield path, os.path.basename(path)
+
+def _convert_file(job):
+    """Convert one file for the output-dir mode, in a worker process.
+
+    Returns (relpath, sha1 of the input, its size in bytes, error message
+    or None).
+    """
+    path, relpath, out_path, encoding, kwargs = job
+    try:
+        fp = open(path, 'rb')
+        try:
+            data = fp.read()
+        finally:
+            fp.close()
+        digest = sha1(data).hexdigest()
+        html = Markdown(**kwargs).convert(data.decode(encoding))
+        out_dir = os.path.dirname(out_path)
+        if out_dir and not os.path.isdir(out_dir):
+            try:
+                os.makedirs(out_dir)
+            except OSError:
+                if not os.path.isdir(out_dir): # not created by another worker
+                    raise
+        fp = codecs.open(out_path, 'w', 'utf-8')
+        try:
+            fp.write(html)
+        finally:
+            fp.close()
+    except Exception:
+        return relpath, None, 0, "%s: %s" % (path, sys.exc_info()[1])
+    return relpath, digest, len(data), None
+
+def _convert_to_dir(paths, output_dir, jobs, encoding, kwargs):
+    """Convert the markdown files in `paths` to HTML files in `output_dir`,
+    mirroring the directory trees, on `jobs` processes.
+
+    Files not modified since the last run, by mtime or by content, are
+    skipped, unless the conversion options changed. Files that would be
+    converted to the same HTML file (e.g. "x.md" and "x.markdown", or the
+    same relative path in two of `paths`) fail instead of overwriting each
+    other. Returns the number of files that failed.
+    """
+    import json
+    start = time.time()
+    options = repr(sorted((k, v) for k, v in kwargs.items()
+                          if k != "link_patterns"))
+    if kwargs.get("link_patterns"):
+        options += repr([(p.pattern, p.flags, href)
+                         for p, href in kwargs["link_patterns"]])
+
+    manifest_path = os.path.join(output_dir, _manifest_name)
+    manifest = {"options": options, "files": {}}
+    if os.path.isfile(manifest_path):
+        fp = open(manifest_path)
+        try:
+            previous = json.load(fp)
+        finally:
+            fp.close()
+        if previous.get("options") == options:
+            manifest["files"] = previous["files"]
+
+    files = {}
+    todo = []
+    failures = 0
+    found = []
+    sources = {}
+    for path, relpath in _markdown_file_paths(paths):
+        out_path = os.path.join(output_dir, os.path.splitext(relpath)[0] + ".html")
+        path_sources = sources.setdefault(os.path.normcase(out_path), [])
+        if path not in path_sources:  # not given twice
+            path_sources.append(path)
+            found.append((path, relpath, out_path))
+    for path, relpath, out_path in found:
+        others = [p for p in sources[os.path.normcase(out_path)] if p != path]
+        if others:
+            log.error("%s: converted to the same file %s as %s", path,
+                      out_path, ", ".join(others))
+            failures += 1
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            log.error("%s: %s", path, sys.exc_info()[1])
+            failures += 1
+            continue
+        entry = manifest["files"].get(relpath)
+        files[relpath] = {"mtime": st.st_mtime, "size": st.st_size,
+                          "sha1": entry and entry["sha1"]}
+        if entry and os.path.exists(out_path):
+            if entry["mtime"] == st.st_mtime and entry["size"] == st.st_size:
+                continue
+            fp = open(path, 'rb')
+            try:
+                if sha1(fp.read()).hexdigest() == entry["sha1"]:
+                    continue
+            finally:
+                fp.close()
+        todo.append((path, relpath, out_path, encoding, kwargs))
+
+    if jobs > 1 and len(todo) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(jobs, len(todo)))
+        try:
+            results = pool.map(_convert_file, todo, chunksize=8)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_convert_file(job) for job in todo]
+
+    converted = converted_bytes = 0
+    for relpath, digest, size, error in results:
+        if error:
+            log.error(error)
+            del files[relpath]
+            failures += 1
+        else:
+            files[relpath]["sha1"] = digest
+            converted += 1
+            converted_bytes += size
+
+    manifest["files"] = files
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    fp = open(manifest_path, 'w')
+    try:
+        json.dump(manifest, fp, indent=0, sort_keys=True)
+    finally:
+        fp.close()
+
+    elapsed = time.time() - start
+    sys.stderr.write("markdown2: converted %d files (%.2f MB) in %.2fs, "
+                     "%.2f MB/s (-j %d); %d unchanged, %d failed\n"
+                     % (converted, converted_bytes / 1e6, elapsed,
+                        converted_bytes / 1e6 / max(elapsed, 1e-6), jobs,
+                        len(files) - converted, failures))
+    return failures
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv
     if not logging.root.handlers:
         logging.basicConfig()
 
-    usage = "usage: %prog [PATHS...]"
+    usage = "usage: %prog [PATHS...]\n       %prog -o DIR [-j N] PATHS..."
     version = "%prog "+__version__
     parser = optparse.OptionParser(prog="markdown2", usage=usage,
         version=version, description=cmdln_desc,
@@ -2219,12 +3202,26 @@ def main(argv=None):
                            "<https://github.com/trentm/python-markdown2/wiki/Extras>")
     parser.add_option("--link-patterns-file",
                       help="path to a link pattern file")
+    parser.add_option("--span-tokenizer", action="store_true",
+                      help="process span-level syntax in a single scan "
+                           "(see `Markdown._tokenize_spans()`)")
+    parser.add_option("-o", "--output-dir", metavar="DIR",
+                      help="write an HTML file in DIR for each markdown file "
+                           "in PATHS, converting directories recursively, "
+                           "and skip the files unchanged since the last run")
+    parser.add_option("-j", "--jobs", type="int",
+                      help="number of processes converting files with "
+                           "-o|--output-dir (default: the number of CPUs)")
+    parser.add_option("--profile", action="store_true",
+                      help="print the time spent in each conversion stage "
+                           "to stderr")
     parser.add_option("--self-test", action="store_true",
                       help="run internal self-tests (some doctests)")
     parser.add_option("--compare", action="store_true",
                       help="run against Markdown.pl as well (for testing)")
     parser.set_defaults(log_level=logging.INFO, compare=False,
-                        encoding="utf-8", safe_mode=None, use_file_vars=False)
+                        encoding="utf-8", safe_mode=None, use_file_vars=False,
+                        span_tokenizer=False, profile=False)
     opts, paths = parser.parse_args()
     log.setLevel(opts.log_level)
 
@@ -2267,6 +3264,23 @@ def main(argv=None):
     else:
         link_patterns = None
 
+    if opts.output_dir:
+        if not paths:
+            parser.error("-o|--output-dir needs PATHS to convert")
+        jobs = opts.jobs
+        if not jobs:
+            try:
+                import multiprocessing
+                jobs = multiprocessing.cpu_count()
+            except (ImportError, NotImplementedError):
+                jobs = 1
+        kwargs = dict(html4tags=opts.html4tags, safe_mode=opts.safe_mode,
+                      extras=extras, link_patterns=link_patterns,
+                      use_file_vars=opts.use_file_vars,
+                      span_tokenizer=opts.span_tokenizer)
+        return _convert_to_dir(paths, opts.output_dir, jobs, opts.encoding,
+                               kwargs) and 1 or 0
+
     from os.path import join, dirname, abspath, exists
     markdown_pl = join(dirname(dirname(abspath(__file__))), "test",
                        "Markdown.pl")
@@ -2296,12 +3310,16 @@ def main(argv=None):
             html4tags=opts.html4tags,
             safe_mode=opts.safe_mode,
             extras=extras, link_patterns=link_patterns,
-            use_file_vars=opts.use_file_vars)
+            use_file_vars=opts.use_file_vars,
+            span_tokenizer=opts.span_tokenizer,
+            profile=opts.profile)
         if py3:
             sys.stdout.write(html)
         else:
             sys.stdout.write(html.encode(
                 sys.stdout.encoding or "utf-8", 'xmlcharrefreplace'))
+        if opts.profile:
+            sys.stderr.write(_format_profile(html.profile))
         if extras and "toc" in extras:
             log.debug("toc_html: " +
                 html.toc_html.encode(sys.stdout.encoding or "utf-8", 'xmlcharrefreplace'))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Conversion tests for markdown2.
+
+Usage, from the package folder:
+
+    python test/run.py            # run all the cases
+    python test/run.py -k fence   # only the cases matching 'fence'
+    python test/run.py --update   # (re)write the expected .html of the cases
+
+Every folder of test/ holds cases converted with one set of options (see
+CONFIGS): a `name.md` input and the `name.html` markdown2 must produce for it.
+The cases of test/links/ use the url_resolver of the preview, and are skipped
+where MarkdownPreview.py cannot be imported (it needs Python 2).
+Each input is converted with `Markdown.convert()`, with the span tokenizer,
+and twice with the same `IncrementalMarkdown`, which must all give the
+expected HTML.
+"""
+
+import io
+import os
+import sys
+from optparse import OptionParser
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_DIR = os.path.dirname(TEST_DIR)
+sys.path.insert(0, PACKAGE_DIR)
+# convert fenced code blocks the way the preview does: the Python embedded
+# in Sublime Text has no pygments
+sys.modules['pygments'] = None
+
+import markdown2
+
+# the extras enabled by MarkdownPreviewJob.get_enabled_extras()
+PREVIEW_EXTRAS = ['footnotes', 'toc', 'fenced-code-blocks', 'cuddled-lists', 'code-friendly']
+
+# the base url of the links of test/links/, as if the document was in /docs
+URL_BASE = u'file:///docs/'
+
+
+def get_links_options():
+    ''' return the options of the cases of test/links/: the url_resolver of the
+        preview of a file in URL_BASE. None if MarkdownPreview.py cannot be imported
+
+        MarkdownPreview.py runs inside Sublime Text: the few sublime calls made at
+        import time are answered here.
+    '''
+    if sys.version_info[0] > 2:
+        return None
+    import types
+    sublime = types.ModuleType('sublime')
+    sublime.version = lambda: '2221'
+    sublime.packages_path = lambda: os.path.dirname(PACKAGE_DIR)
+    sublime_plugin = types.ModuleType('sublime_plugin')
+    for name in ('EventListener', 'ApplicationCommand', 'WindowCommand', 'TextCommand'):
+        setattr(sublime_plugin, name, object)
+    sys.modules.setdefault('sublime', sublime)
+    sys.modules.setdefault('sublime_plugin', sublime_plugin)
+    import MarkdownPreview
+    return {'extras': PREVIEW_EXTRAS,
+            'url_resolver': lambda url: MarkdownPreview.resolve_url(URL_BASE, url)}
+
+
+# the Markdown options of the cases of each folder, a callable for the ones
+# that are only known once needed (None: skip the folder)
+CONFIGS = {
+    'preview': {'extras': PREVIEW_EXTRAS},
+    # examples of the GitHub Flavored Markdown spec, https://github.github.com/gfm/
+    'gfm': {'extras': ['gfm']},
+    'links': get_links_options,
+}
+
+
+def read(path):
+    f = io.open(path, encoding='utf-8', newline='')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def write(path, text):
+    f = io.open(path, 'w', encoding='utf-8', newline='')
+    try:
+        f.write(text)
+    finally:
+        f.close()
+
+
+def get_cases():
+    ''' return the (config, name) of the cases '''
+    cases = []
+    for config in sorted(CONFIGS):
+        for filename in sorted(os.listdir(os.path.join(TEST_DIR, config))):
+            if filename.endswith('.md'):
+                cases.append((config, filename[:-len('.md')]))
+    return cases
+
+
+def get_options(config):
+    ''' return the Markdown options of the cases of config, None to skip them '''
+    options = CONFIGS[config]
+    if callable(options):
+        options = CONFIGS[config] = options()
+    return options
+
+
+def run_case(config, name, update=False):
+    ''' convert one case, return its failures, as messages '''
+    options = get_options(config)
+    path = os.path.join(TEST_DIR, config, name)
+    text = read(path + '.md')
+    html = markdown2.Markdown(**options).convert(text)
+    if update:
+        write(path + '.html', html)
+    expected = read(path + '.html')
+
+    failures = []
+    if html != expected:
+        failures.append('Markdown.convert')
+    if markdown2.Markdown(span_tokenizer=True, **options).convert(text) != expected:
+        failures.append('Markdown.convert, span_tokenizer=True')
+    incremental = markdown2.IncrementalMarkdown(**options)
+    if incremental.convert(text) != expected:
+        failures.append('IncrementalMarkdown.convert')
+    if incremental.convert(text) != expected:
+        failures.append('IncrementalMarkdown.convert, second call')
+    return failures
+
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-k', dest='filter', help='only run the cases containing this string')
+    parser.add_option('--update', action='store_true',
+                      help='write the Markdown.convert output as the expected HTML')
+    opts, args = parser.parse_args(argv[1:])
+
+    count = failed = skipped = 0
+    for config, name in get_cases():
+        case = '%s/%s' % (config, name)
+        if opts.filter and opts.filter not in case:
+            continue
+        if get_options(config) is None:
+            skipped += 1
+            continue
+        count += 1
+        failures = run_case(config, name, opts.update)
+        for failure in failures:
+            print('FAIL %s: %s' % (case, failure))
+        if failures:
+            failed += 1
+
+    print('%d cases, %d failed, %d skipped' % (count, failed, skipped))
+    return failed and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())